@@ -6,7 +6,17 @@ the migration SQL queries in migrations.py
 """
 
 TRANSACTIONS_DB_SCHEMA_NAME = "TRANSACTION"
-TRANSACTIONS_DB_SCHEMA_VERSION = 18
+TRANSACTIONS_DB_SCHEMA_VERSION = 19
 
 RETRY_DATABASE_OP_SECONDS = 5
 RETRY_DATABASE_OP_TIMES = 360
+
+"""PRAGMAs set on the SQLite databases of a TransactionDB. The journal mode
+is stored in the database file and set once per engine, the others on every
+new connection. The busy timeout is left to the driver's `timeout` connect
+argument."""
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('temp_store', 'MEMORY'),
+]
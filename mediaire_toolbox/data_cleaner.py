@@ -1,6 +1,8 @@
 import time
 import os
+import re
 import fnmatch
+import functools
 import logging
 import argparse
 
@@ -40,7 +42,7 @@ class DataCleaner:
     def __init__(self, folder: str, folder_size_soft_limit: int,
                  folder_size_hard_limit: int, max_data_seconds: int,
                  min_data_seconds: int = -1, whitelist=None, blacklist=None,
-                 priority_list=None):
+                 priority_list=None, *, scan_fn=None, time_fn=None):
         """
         Parameters
         ----------
@@ -75,6 +77,12 @@ class DataCleaner:
             pattern_A are
             deleted. then the files matching pattern_B and then at last
             files matching pattern_C.
+        scan_fn: callable
+            Returns the list of (filename, creation_time, filesize) tuples
+            of the files in a folder. Defaults to scanning the file system.
+        time_fn: callable
+            Returns the current time in seconds since the epoch, evaluated
+            once per clean_up. Defaults to time.time.
         """
         self.base_folder = folder
         if folder_size_soft_limit > folder_size_hard_limit:
@@ -100,6 +108,8 @@ class DataCleaner:
             % (folder, self.soft_limit, self.hard_limit, max_data_seconds))
 
         self.priority_list = priority_list if priority_list else []
+        self.scan_fn = scan_fn
+        self.time_fn = time_fn
         self._check_valid_init()
 
     def _check_valid_init(self):
@@ -109,35 +119,38 @@ class DataCleaner:
                 "Datacleaner will not clean anything.")
 
     @staticmethod
-    def scan_dir(path):
-        """Scans the directory and its subfolders for all files,
-        and return a list of filepaths"""
-        entries = []
+    def _walk_files(path):
+        """Yields a (filepath, os.DirEntry) tuple for every file in the
+        directory and its subfolders"""
         for entry in os.scandir(path):
             # recursion when entry is a subfolder
             if entry.is_dir(follow_symlinks=False):
-                entries += DataCleaner.scan_dir(os.path.join(path, entry.name))
+                yield from DataCleaner._walk_files(
+                    os.path.join(path, entry.name))
             elif entry.is_file(follow_symlinks=False):
-                entries.append(os.path.join(path, entry.name))
-        return entries
+                yield os.path.join(path, entry.name), entry
 
     @staticmethod
-    def _creation_time_and_size(file):
-        """Returns a (filename, creation_time, filesize) tuple"""
-        stat = os.stat(file)
-        return file, stat.st_ctime, stat.st_size
+    def scan_dir(path):
+        """Scans the directory and its subfolders for all files,
+        and return a list of filepaths"""
+        return [filepath for filepath, _ in DataCleaner._walk_files(path)]
 
     @staticmethod
-    def _get_file_stats(filelist):
-        """Transforms a list of filenames to a list of
-        (filename, creation_time, filesize) tuples"""
+    def _scan_dir_stats(path):
+        """Scans the directory and its subfolders for all files,
+        and return a list of (filename, creation_time, filesize) tuples.
+        The stats are taken from the directory entries, so there is no
+        separate path resolution per file"""
         to_return = []
-        for f in filelist:
+        for filepath, entry in DataCleaner._walk_files(path):
             try:
-                to_return.append(DataCleaner._creation_time_and_size(f))
+                stat = entry.stat(follow_symlinks=False)
             except Exception:
                 default_logger.warn("Exception issuing os.stat",
                                     exc_info=True)
+                continue
+            to_return.append((filepath, stat.st_ctime, stat.st_size))
         return to_return
 
     @staticmethod
@@ -146,11 +159,11 @@ class DataCleaner:
         by time, ascending"""
         return sorted(filestat_list, key=lambda x: x[1])
 
-    def _filter_too_young_files(self, filestat_list):
+    def _filter_too_young_files(self, filestat_list, current_time=None):
         """Remove candidates from the (filename, creation_time, filesize)
         which are too young to be deleted"""
         return filter(lambda x: not self._check_too_young(
-            x[1], self.min_data_seconds), filestat_list)
+            x[1], self.min_data_seconds, current_time), filestat_list)
 
     @staticmethod
     def _sum_filestat_list(filestat_list):
@@ -161,24 +174,37 @@ class DataCleaner:
     def _get_current_time():
         return time.time()
 
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _compile_patterns(patterns):
+        """Compiles a tuple of Unix filename patterns into a single regular
+        expression matching any of them, see fnmatch.fnmatch"""
+        return re.compile('|'.join(
+            '(?:{})'.format(fnmatch.translate(os.path.normcase(pattern)))
+            for pattern in patterns))
+
     @staticmethod
     def _fnmatch(file, pattern_list):
         """Returns true if the filename matches with a list of patterns"""
-        for pattern in pattern_list:
-            if fnmatch.fnmatch(file, pattern):
-                return True
-        return False
+        if not pattern_list:
+            return False
+        return DataCleaner._compile_patterns(tuple(pattern_list)).match(
+            os.path.normcase(file)) is not None
 
     @staticmethod
-    def _check_too_young(c_time, min_data_seconds):
+    def _check_too_young(c_time, min_data_seconds, current_time=None):
         """Returns true if the file can't be removed because it's too young"""
-        age = DataCleaner._get_current_time() - c_time
+        if current_time is None:
+            current_time = DataCleaner._get_current_time()
+        age = current_time - c_time
         return age < min_data_seconds
 
     @staticmethod
-    def _check_remove_time(c_time, max_data_seconds):
+    def _check_remove_time(c_time, max_data_seconds, current_time=None):
         """Returns true the file should be removed because it is too old"""
-        age = DataCleaner._get_current_time() - c_time
+        if current_time is None:
+            current_time = DataCleaner._get_current_time()
+        age = current_time - c_time
         return max_data_seconds < age
 
     @staticmethod
@@ -238,7 +264,8 @@ class DataCleaner:
     @staticmethod
     def clean_files_by_date(
             filelist, max_data_seconds,
-            whitelist=None, blacklist=None, clean_folder=False):
+            whitelist=None, blacklist=None, clean_folder=False,
+            current_time=None):
         """Clean files that are older than max_data_seconds.
 
         Parameters
@@ -250,6 +277,8 @@ class DataCleaner:
         clean_folder: boolean
             True if all files in a deleted folder should be removed.
             Usecase: remove all dcm files in a folder if one is removed
+        current_time: float
+            time to compute the age of files from, defaults to now
 
         Returns
         -------
@@ -264,7 +293,7 @@ class DataCleaner:
             if (DataCleaner._check_remove_filter(
                     file, whitelist, blacklist) and
                     DataCleaner._check_remove_time(
-                    creation_time, max_data_seconds)):
+                    creation_time, max_data_seconds, current_time)):
                 removed.append(filelist[i])
                 removed_index_list.append(i)
                 if clean_folder:
@@ -330,9 +359,10 @@ class DataCleaner:
             return []
 
         if pattern:
+            match = DataCleaner._compile_patterns((pattern,)).match
             remove_cands = [
                 file_obj for file_obj in filelist
-                if fnmatch.fnmatch(file_obj[0], pattern)]
+                if match(os.path.normcase(file_obj[0]))]
         else:
             return []
 
@@ -369,30 +399,36 @@ class DataCleaner:
     def clean_files_by_size_optimized(
             filelist, reduce_size, whitelist=None,
             pattern: str = None):
-        """Remove files, remove oldest files first"""
+        """Remove files, remove oldest files first. The candidates are
+        matched lazily, files after the size requirement is met are not
+        looked at"""
         if reduce_size < 0:
             return []
 
         if pattern:
+            match = DataCleaner._compile_patterns((pattern,)).match
             if whitelist:
-                remove_cands = [
+                whitelist_match = DataCleaner._compile_patterns(
+                    tuple(whitelist)).match
+                remove_cands = (
                     file_obj for file_obj in filelist
-                    if DataCleaner._fnmatch(file_obj[0], [pattern])
-                    and not DataCleaner._fnmatch(file_obj[0], whitelist)
-                    ]
+                    if match(os.path.normcase(file_obj[0]))
+                    and not whitelist_match(os.path.normcase(file_obj[0]))
+                    )
             else:
-                remove_cands = [
+                remove_cands = (
                     file_obj for file_obj in filelist
-                    if fnmatch.fnmatch(file_obj[0], pattern)]
+                    if match(os.path.normcase(file_obj[0])))
         else:
             return []
 
-        i = -1
-        for i, file_obj in enumerate(remove_cands):
+        removed = []
+        for file_obj in remove_cands:
+            removed.append(file_obj)
             reduce_size -= file_obj[2]
             if reduce_size < 0:
                 break
-        return remove_cands[:i + 1]
+        return removed
 
     @staticmethod
     def remove_files(remove_list):
@@ -466,9 +502,11 @@ class DataCleaner:
             default_logger.info(
                 "No age or size limit specified. Skipping clean up.")
             return
-        filelist = self.scan_dir(self.base_folder)
-        filelist = self._get_file_stats(filelist)
-        filelist = self._filter_too_young_files(filelist)
+        scan_fn = self.scan_fn or self._scan_dir_stats
+        time_fn = self.time_fn or self._get_current_time
+        filelist = scan_fn(self.base_folder)
+        current_time = time_fn()
+        filelist = self._filter_too_young_files(filelist, current_time)
         filelist = self._sort_filestat_list_by_time(filelist)
         remove_list = []
         if self.max_data_seconds > 0:
@@ -477,7 +515,7 @@ class DataCleaner:
             date_blacklist = blacklist + self.priority_list
             remove_list += self.clean_files_by_date(
                 filelist, self.max_data_seconds,
-                whitelist, date_blacklist
+                whitelist, date_blacklist, current_time=current_time
             )
 
         if self.hard_limit_bytes > 0:
@@ -1,4 +1,4 @@
-import json
+from mediaire_toolbox.transaction_db import json_codec
 import logging
 
 default_logger = logging.getLogger(__name__)
@@ -6,7 +6,7 @@ default_logger = logging.getLogger(__name__)
 
 def set_index_institution(transaction):
     try:
-        institution = (json.loads(transaction.last_message)['data']
+        institution = (json_codec.loads(transaction.last_message)['data']
                        ['dicom_info']['t1']['header']['InstitutionName'])
     except Exception:
         institution = ''
@@ -17,7 +17,7 @@ def set_index_sequences(transaction):
     sequence_list = []
     for series_type in ['t1', 't2']:
         try:
-            sequence = (json.loads(transaction.last_message)['data']
+            sequence = (json_codec.loads(transaction.last_message)['data']
                         ['dicom_info'][series_type]['header']
                         ['SeriesDescription'])
             sequence_list.append(sequence)
@@ -28,7 +28,7 @@ def set_index_sequences(transaction):
 
 def set_index_study_date(transaction):
     try:
-        study_date = (json.loads(transaction.last_message)['data']
+        study_date = (json_codec.loads(transaction.last_message)['data']
                       ['dicom_info']['t1']['header']['StudyDate'])
     except Exception:
         study_date = ''
@@ -39,7 +39,8 @@ def set_index_version(transaction):
     """Migration script. Index the version number in the last_message
     field to the 'version' column"""
     try:
-        version = (json.loads(transaction.last_message)['data']['version'])
+        version = (json_codec.loads(transaction.last_message)
+                   ['data']['version'])
     except Exception:
         version = None
     if version:
@@ -51,7 +52,7 @@ def set_index_analysis_type(transaction):
     of the transaction to the 'analysis type' column"""
     try:
         report_pdf_paths = (
-            json.loads(transaction.last_message)['data']
+            json_codec.loads(transaction.last_message)['data']
             ['report_pdf_paths'])
         type_string = ';'.join(report_pdf_paths.keys())
     except Exception:
@@ -69,7 +70,7 @@ def set_index_report_qa(transaction):
     to the 'qa_score' column"""
     try:
         qa_score_outcomes = (
-            json.loads(transaction.last_message)['data']
+            json_codec.loads(transaction.last_message)['data']
             ['report_qa_score_outcomes'])
     except Exception:
         qa_score_outcomes = {}
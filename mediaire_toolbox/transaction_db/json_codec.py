@@ -0,0 +1,60 @@
+"""JSON serialization of transaction messages.
+
+Uses orjson when it is installed (pip install mediaire_toolbox[orjson]),
+which parses and serializes considerably faster, and the standard library
+json module otherwise. Both return compact str from dumps(), without
+spaces after the separators, so that the stored messages look the same
+whichever module serialized them.
+
+orjson is stricter than the json module, so the json module still handles
+what orjson would reject or change: NaN and Infinity, which the json module
+writes for float volumes and orjson serializes as null, and integers wider
+than 64 bits, which orjson refuses to serialize and parses as floats."""
+import json
+import math
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj) -> str:
+    # the separators of orjson
+    return json.dumps(obj, separators=(',', ':'))
+
+
+if orjson is not None:
+    # any integer wider than 64 bits has at least 19 digits. Only number
+    # tokens are matched, not digits inside strings such as DICOM UIDs
+    _LONG_INTEGER = re.compile(r'(?:^|[:\[,])\s*-?\d{19,}\s*(?:[,\]}]|$)')
+
+    def _has_non_finite(obj) -> bool:
+        if isinstance(obj, float):
+            return not math.isfinite(obj)
+        if isinstance(obj, dict):
+            return any(_has_non_finite(value) for value in obj.values())
+        if isinstance(obj, (list, tuple)):
+            return any(_has_non_finite(value) for value in obj)
+        return False
+
+    def loads(s):
+        if _LONG_INTEGER.search(s):
+            return json.loads(s)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return json.loads(s)
+
+    def dumps(obj) -> str:
+        try:
+            serialized = orjson.dumps(obj)
+        except TypeError:
+            return _json_dumps(obj)
+        if b'null' in serialized and _has_non_finite(obj):
+            return _json_dumps(obj)
+        return serialized.decode('utf-8')
+else:
+    loads = json.loads
+    dumps = _json_dumps
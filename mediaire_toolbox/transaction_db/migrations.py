@@ -1,6 +1,8 @@
 from mediaire_toolbox.transaction_db import index
 import logging
 
+from sqlalchemy import text
+
 default_logger = logging.getLogger(__name__)
 
 """SQL Commands that need to be issued in order to migrate the TransactionsDB
@@ -8,11 +10,15 @@ from one version to another. Keyed by target version ID."""
 MIGRATIONS = {
     2: [
         "ALTER TABLE transactions ADD COLUMN task_progress INT DEFAULT 0",
-        "UPDATE transactions SET task_progress = 10 WHERE processing_state = 'spm_lesion'",
-        "UPDATE transactions SET task_progress = 10 WHERE processing_state = 'spm_volumetry'",
-        "UPDATE transactions SET task_progress = 80 WHERE processing_state = 'volumetry_assessment'",
-        "UPDATE transactions SET task_progress = 90 WHERE processing_state = 'report'",
-        "UPDATE transactions SET task_progress = 100 WHERE processing_state = 'send_to_pacs'"
+        "UPDATE transactions SET task_progress = CASE processing_state"
+        "  WHEN 'spm_lesion' THEN 10"
+        "  WHEN 'spm_volumetry' THEN 10"
+        "  WHEN 'volumetry_assessment' THEN 80"
+        "  WHEN 'report' THEN 90"
+        "  WHEN 'send_to_pacs' THEN 100"
+        " END"
+        " WHERE processing_state IN ('spm_lesion', 'spm_volumetry',"
+        "  'volumetry_assessment', 'report', 'send_to_pacs')"
     ],
     3: [
         "ALTER TABLE transactions ADD COLUMN task_skipped INT DEFAULT 0",
@@ -24,8 +30,8 @@ MIGRATIONS = {
         "ALTER TABLE transactions ADD COLUMN status TEXT",
         "ALTER TABLE transactions ADD COLUMN institution TEXT",
         "ALTER TABLE transactions ADD COLUMN sequences TEXT",
-        "UPDATE transactions SET status = 'sent_to_pacs' WHERE processing_state = 'send_to_pacs'",
-        "UPDATE transactions SET status = 'unseen' WHERE processing_state != 'send_to_pacs'"
+        # status is filled in batches by migrate_status, see
+        # MIGRATIONS_SCRIPTS[5]
     ],
     6: [
         "ALTER TABLE transactions ADD COLUMN archived INT DEFAULT 0",
@@ -90,9 +96,46 @@ MIGRATIONS = {
         "  FOREIGN KEY (user_id) REFERENCES users(id),"
         "  FOREIGN KEY (site_id) REFERENCES sites(id)"
         ");"
+    ],
+    19: [
+        # TransactionDB.peek_queued, also declared in the model
+        "CREATE INDEX IF NOT EXISTS ix_tx_queue ON transactions"
+        "(task_state, archived, processing_state, transaction_id)"
     ]
 }
 
+"""MIGRATIONS as SQL statement objects, built once when loading the module."""
+COMPILED_MIGRATIONS = {
+    version: [text(command) for command in commands]
+    for version, commands in MIGRATIONS.items()
+}
+
+
+# rows without processing_state keep a NULL status
+MIGRATE_STATUS = text(
+    "UPDATE transactions SET status = CASE"
+    "  WHEN processing_state = 'send_to_pacs' THEN 'sent_to_pacs'"
+    "  ELSE 'unseen'"
+    " END"
+    " WHERE processing_state IS NOT NULL"
+    "  AND transaction_id BETWEEN :lo AND :hi")
+
+
+def migrate_status(session, model, batch_size=30000):
+    """Fill the status column in chunks of batch_size transaction ids,
+    committing after each chunk, so that no single write transaction holds
+    the changes of the whole table and blocks readers until it ends."""
+    lo, hi = session.execute(text(
+        "SELECT MIN(transaction_id), MAX(transaction_id) FROM transactions"
+    )).fetchone()
+    if lo is None:
+        return
+    for start in range(lo, hi + 1, batch_size):
+        session.execute(
+            MIGRATE_STATUS, {'lo': start, 'hi': start + batch_size - 1}
+        ).close()
+        session.commit()
+
 
 def migrate_institution(session, model):
     for transaction in session.query(model).all():
@@ -150,6 +193,7 @@ def migrate_qa_scores(session, model):
 
 MIGRATIONS_SCRIPTS = {
     5: [
+        migrate_status,
         migrate_institution,
         migrate_sequences,
     ],
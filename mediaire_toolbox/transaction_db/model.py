@@ -3,7 +3,7 @@ import datetime
 
 from sqlalchemy import (
     Column, Integer, String, Sequence, DateTime, Date, Enum, ForeignKey,
-    TypeDecorator
+    Index, TypeDecorator
 )
 from sqlalchemy.ext.declarative import declarative_base
 from passlib.apps import custom_app_context as pwd_context
@@ -129,6 +129,12 @@ class Transaction(Base):
     # transactions are dequeued
     priority = Column(Integer, default=0)
 
+    __table_args__ = (
+        # covers the filters and the ordering of TransactionDB.peek_queued
+        Index('ix_tx_queue',
+              'task_state', 'archived', 'processing_state', 'transaction_id'),
+    )
+
     @staticmethod
     def _datetime_to_str(dt: Optional[datetime.datetime]):
         return dt.strftime("%Y-%m-%d %H:%M:%S") if dt else None
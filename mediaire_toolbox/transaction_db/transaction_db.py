@@ -1,49 +1,122 @@
 from typing import List
+from collections import OrderedDict
+import functools
+import hashlib
 import logging
-import json
 import threading
 import shutil
+import weakref
+from contextlib import closing, contextmanager
 
 import datetime
 
-from sqlalchemy.ext.automap import automap_base
+from sqlalchemy import event, inspect, insert
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from mediaire_toolbox.constants import (TRANSACTIONS_DB_SCHEMA_NAME,
-                                        TRANSACTIONS_DB_SCHEMA_VERSION)
+                                        TRANSACTIONS_DB_SCHEMA_VERSION,
+                                        SQLITE_PRAGMAS)
 from mediaire_toolbox.transaction_db.model import (
     Transaction, SchemaVersion, create_all, UserTransaction, User, Role,
     UserRole, UserPreferences, StudiesMetadata, UserSite
 )
 from mediaire_toolbox.transaction_db.exceptions import TransactionDBException
-from mediaire_toolbox.transaction_db import migrations, index
+from mediaire_toolbox.transaction_db import migrations, index, json_codec
 from mediaire_toolbox.task_state import TaskState
 from mediaire_toolbox.transaction_db.t_db_retry import t_db_retry
 
 
 logger = logging.getLogger(__name__)
 
+"""Transaction columns that can be set with update_transaction and
+update_many"""
+UPDATABLE_TRANSACTION_FIELDS = frozenset([
+    'task_state', 'processing_state', 'last_message', 'task_progress',
+    'task_cancelled', 'task_skipped', 'error', 'status', 'start_date',
+    'end_date', 'archived', 'patient_consent', 'qa_score', 'billable',
+    'priority'
+])
+
+
+def schema_checksum(columns, indexes=()):
+    """Checksum of a table definition given by its column and index names,
+    independent of their order."""
+    definition = (tuple(sorted(columns)), tuple(sorted(indexes)))
+    return hashlib.sha256(repr(definition).encode('utf-8')).hexdigest()
+
+
+"""Checksum of the transactions table as defined by the model, i.e. as it is
+once migrated to TRANSACTIONS_DB_SCHEMA_VERSION"""
+TRANSACTIONS_SCHEMA_CHECKSUM = schema_checksum(
+    [column.name for column in Transaction.__table__.columns],
+    [index.name for index in Transaction.__table__.indexes])
+
+
+def get_schema_checksum(engine):
+    """Checksum of the transactions table as it exists in the database.
+    Only indexes that the model declares are taken into account."""
+    inspector = inspect(engine)
+    model_indexes = set(index.name for index in Transaction.__table__.indexes)
+    return schema_checksum(
+        [column['name'] for column in
+         inspector.get_columns(Transaction.__tablename__)],
+        [index['name'] for index in
+         inspector.get_indexes(Transaction.__tablename__)
+         if index['name'] in model_indexes])
+
 
 def get_transaction_model(engine):
-    Base = automap_base()
-    Base.prepare(engine, reflect=True)
-    return Base.classes.transactions
+    """Return the model class migration scripts operate on.
+
+    Migration scripts run once the schema is fully migrated, so this is the
+    declarative Transaction model; reflecting the schema isn't needed. The
+    engine argument is kept for compatibility."""
+    return Transaction
 
 
 def migrate_scripts(session, engine, current_version, target_version):
     model = get_transaction_model(engine)
     for version in range(current_version + 1, target_version + 1):
+        logger.warning("Started Database migration script to version {}....."
+                       "DO NOT STOP PIPELINE".format(version))
         try:
             for script in migrations.MIGRATIONS_SCRIPTS.get(
                     version, []):
                 script(session, model)
             session.commit()
+            logger.warning("Finished migration script")
         except Exception as e:
             session.rollback()
-            session.close()
             logger.exception(e)
             raise e
-    session.close()
+
+
+@contextmanager
+def migration_transaction(session, sqlite):
+    """On SQLite, run the block inside a 'BEGIN IMMEDIATE' transaction which
+    is issued and ended on the DBAPI connection of the session. The sqlite3
+    module is kept out of it by setting its isolation_level to None:
+    otherwise, before Python 3.6, it commits implicitly ahead of DDL
+    statements such as ALTER TABLE. Pending ORM changes are flushed into
+    the transaction before it commits."""
+    if not sqlite:
+        yield
+        return
+    dbapi_connection = session.connection().connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    try:
+        dbapi_connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            session.flush()
+            dbapi_connection.execute("COMMIT")
+        except BaseException:
+            if dbapi_connection.in_transaction:
+                dbapi_connection.execute("ROLLBACK")
+            raise
+    finally:
+        dbapi_connection.isolation_level = isolation_level
 
 
 def migrate(session, engine, db_version):
@@ -57,37 +130,59 @@ def migrate(session, engine, db_version):
     if we need to add the complexity of such tools on our stack. So we do it
     ourselves here.
 
+    On SQLite, the commands of each version are issued inside a single
+    'BEGIN IMMEDIATE' transaction, so that a version costs one fsync instead
+    of one per statement. The PRAGMAs (e.g. WAL journal mode) are the ones
+    TransactionDB sets on the database and the connections of the engine.
+
     After migrating with sql commands (changing dababase schema),
     we also run python scripts to index values parsed from the dicom header.
     Note that the schema_version does not correspond to the indexed values:
     i.e a schema_version of 5 does not mean the values are indexed.
     """
+    sqlite = engine.dialect.name == 'sqlite'
     from_schema_version = db_version.schema_version
     for version in range(from_schema_version + 1,
                          TRANSACTIONS_DB_SCHEMA_VERSION + 1):
         logger.info("Applying database migration to version %s" % version)
         try:
-            for command in migrations.MIGRATIONS[version]:
-                session.execute(command).close()
-            db_version.schema_version = version
+            with migration_transaction(session, sqlite):
+                for command in migrations.COMPILED_MIGRATIONS[version]:
+                    with closing(session.execute(command)):
+                        pass
+                db_version.schema_version = version
             session.commit()
         except Exception as e:
             session.rollback()
-            session.close()
             raise e
-    for version in range(
-            from_schema_version + 1, TRANSACTIONS_DB_SCHEMA_VERSION + 1):
-        logger.warning("Started Database migration script to version {}....."
-                       "DO NOT STOP PIPELINE".format(version))
-        migrate_scripts(
-            session, engine,
-            from_schema_version, TRANSACTIONS_DB_SCHEMA_VERSION)
-        logger.warning("Finished migration script")
-
-
-def lock(func):
-    """Decorator for lock management"""
-
+    migrate_scripts(
+        session, engine, from_schema_version, TRANSACTIONS_DB_SCHEMA_VERSION)
+
+
+def set_message_t_id(last_message: str, t_id: int) -> str:
+    """Return the JSON object last_message with its 't_id' set. Messages
+    without any 't_id' key are patched as a string instead of being parsed
+    and serialized again. Messages that aren't JSON objects are returned
+    unchanged."""
+    if (last_message.startswith('{') and
+            last_message.rstrip().endswith('}') and
+            '"t_id"' not in last_message):
+        rest = last_message[1:]
+        separator = '' if rest.lstrip().startswith('}') else ','
+        return '{{"t_id":{}{}{}'.format(t_id, separator, rest)
+    try:
+        lm = json_codec.loads(last_message)
+        lm['t_id'] = t_id
+        return json_codec.dumps(lm)
+    except Exception:
+        return last_message
+
+
+def write_lock(func):
+    """Decorator for lock management. Serializes the methods which write to
+    the database."""
+
+    @functools.wraps(func)
     def wrapper(self, *args, **kwargs):
         try:
             self.lock.acquire()
@@ -97,6 +192,45 @@ def lock(func):
     return wrapper
 
 
+def set_sqlite_pragmas_on_connect(engine, pragmas):
+    """Register a listener that sets the given (pragma, value) pairs on
+    every new DBAPI connection of the engine."""
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma, value in pragmas:
+                cursor.execute("PRAGMA {}={}".format(pragma, value))
+        finally:
+            cursor.close()
+
+    event.listen(engine, 'connect', set_pragmas)
+
+
+def set_sqlite_journal_mode(engine, journal_mode):
+    """Set the journal mode of the SQLite database of the engine. Unlike
+    most PRAGMAs, it is stored in the database file, so it only needs to
+    be set once instead of on every connection."""
+    with closing(engine.connect()) as connection:
+        connection.execute(
+            "PRAGMA journal_mode={}".format(journal_mode)).close()
+
+
+def checkpoint_sqlite_wal(session):
+    """Write the SQLite write-ahead log back into the database file, so
+    that the file alone holds every committed transaction. Returns False if
+    other connections kept the checkpoint from completing."""
+    with closing(session.execute("PRAGMA wal_checkpoint(TRUNCATE)")) as result:
+        busy, _, _ = result.fetchone()
+    return not busy
+
+
+def read_lock(func):
+    """Decorator for methods which only read from the database. They don't
+    take the lock: every thread gets its own scoped session, and SQLite in
+    WAL mode lets readers run concurrently with the writer."""
+    return func
+
+
 def utcnow():
     """Return _aware_ `datetime.now()` object in UTC timezone.
 
@@ -123,7 +257,17 @@ class TransactionDB:
     """Connection to a DB of transactions where we can track status, failures,
     elapsed time, etc."""
 
-    def __init__(self, engine, create_db=True, db_file_path=None):
+    """Schema version of the databases already created or migrated in this
+    process, keyed by engine, so that further instances on the same engine
+    don't look it up again"""
+    _schema_version_cache = weakref.WeakKeyDictionary()
+
+    """PRAGMAs set on the connections of each SQLite engine, keyed by engine,
+    so that the connect listener is only registered once per engine"""
+    _sqlite_pragmas = weakref.WeakKeyDictionary()
+
+    def __init__(self, engine, create_db=True, db_file_path=None,
+                 sqlite_pragmas: dict = None):
         """
         Parameters
         ----------
@@ -133,12 +277,39 @@ class TransactionDB:
         db_file_path: path
             If create_db, create an backup for
             this file if migration is triggered
+        sqlite_pragmas: dict
+            For SQLite engines, PRAGMAs to set on top of (or instead of)
+            constants.SQLITE_PRAGMAS, e.g. {'synchronous': 'FULL'} for
+            stronger durability. journal_mode is set once on the database,
+            the others on every new connection. A value of None leaves that
+            PRAGMA untouched. They are fixed by the first TransactionDB
+            created on an engine.
         """
-        # lock for atomic operations
-        self.lock = threading.RLock()
+        # lock for atomic write operations
+        self.lock = threading.Lock()
+
+        if engine.dialect.name == 'sqlite':
+            pragmas = OrderedDict(SQLITE_PRAGMAS)
+            pragmas.update(sqlite_pragmas or {})
+            pragmas = [(pragma, value) for pragma, value in pragmas.items()
+                       if value is not None]
+            engine_pragmas = TransactionDB._sqlite_pragmas.get(engine)
+            if engine_pragmas is None:
+                connect_pragmas = []
+                for pragma, value in pragmas:
+                    if pragma == 'journal_mode':
+                        set_sqlite_journal_mode(engine, value)
+                    else:
+                        connect_pragmas.append((pragma, value))
+                set_sqlite_pragmas_on_connect(engine, connect_pragmas)
+                TransactionDB._sqlite_pragmas[engine] = pragmas
+            elif engine_pragmas != pragmas:
+                logger.warning(
+                    "SQLite PRAGMAs of this engine are already set to {}, "
+                    "ignoring {}".format(engine_pragmas, pragmas))
 
         self.session = scoped_session(sessionmaker(bind=engine))
-        if create_db:
+        if create_db and engine not in TransactionDB._schema_version_cache:
             create_all(engine)
             db_version = self.session.query(
                 SchemaVersion).get(TRANSACTIONS_DB_SCHEMA_NAME)
@@ -151,18 +322,39 @@ class TransactionDB:
             else:
                 # check if the existing database is old, and if so migrate
                 if db_version.schema_version < TRANSACTIONS_DB_SCHEMA_VERSION:
-                    if db_file_path:
-                        dest_path = db_file_path + '.v_{}.bkp'.format(
-                            db_version.schema_version)
-                        shutil.copy(db_file_path, dest_path)
-                        logger.info(
-                            "Created backup for file '{}'"
-                            .format(db_file_path))
-
-                    migrate(self.session, engine, db_version)
+                    self._migrate(engine, db_version, db_file_path)
+            TransactionDB._schema_version_cache[engine] = \
+                TRANSACTIONS_DB_SCHEMA_VERSION
+
+    def _migrate(self, engine, db_version, db_file_path=None):
+        if get_schema_checksum(engine) == TRANSACTIONS_SCHEMA_CHECKSUM:
+            # the schema was already migrated without updating its version,
+            # e.g. by ops tooling; running the DDL again would fail
+            logger.warning(
+                "Database schema version is {} but the transactions table "
+                "already matches version {}, skipping migrations".format(
+                    db_version.schema_version, TRANSACTIONS_DB_SCHEMA_VERSION))
+            db_version.schema_version = TRANSACTIONS_DB_SCHEMA_VERSION
+            self.session.commit()
+            return
+
+        if db_file_path:
+            # in WAL mode, recent transactions may only be in the -wal file
+            if (engine.dialect.name == 'sqlite' and
+                    not checkpoint_sqlite_wal(self.session)):
+                logger.warning(
+                    "Could not checkpoint the write-ahead log of '{}', the "
+                    "backup might miss recent transactions"
+                    .format(db_file_path))
+            dest_path = db_file_path + '.v_{}.bkp'.format(
+                db_version.schema_version)
+            shutil.copy(db_file_path, dest_path)
+            logger.info("Created backup for file '{}'".format(db_file_path))
+
+        migrate(self.session, engine, db_version)
 
     @t_db_retry
-    @lock
+    @write_lock
     def create_transaction(self,
                            t: Transaction,
                            user_id=None,
@@ -198,8 +390,8 @@ class TransactionDB:
             if qa_score:
                 t.qa_score = qa_score
             self.session.add(t)
-            # when we commit, we get the transaction ID
-            self.session.commit()
+            # when we flush, we get the transaction ID
+            self.session.flush()
             if user_id:
                 user = self.session.query(User).get(user_id)
                 if not user:
@@ -209,31 +401,22 @@ class TransactionDB:
                 ut.user_id = user_id
                 ut.transaction_id = t.transaction_id
                 self.session.add(ut)
-            self.session.commit()
 
             # set the transaction id in the task object
             if t.last_message:
-                try:
-                    lm = json.loads(t.last_message)
-                    lm['t_id'] = t.transaction_id
-                    t.last_message = json.dumps(lm)
-                except Exception:
-                    pass
+                t.last_message = set_message_t_id(
+                    t.last_message, t.transaction_id)
             # index.set_index_institution(t)
             index.set_index_sequences(t)
             self.session.commit()
             return t.transaction_id
         except Exception:
+            # the rollback also discards the flushed transaction
             self.session.rollback()
-            try:
-                if(t.transaction_id):
-                    self.session.delete(t)
-            except Exception:
-                pass
             raise
 
     @t_db_retry
-    @lock
+    @read_lock
     def get_transaction(self, id_: int) -> Transaction:
         try:
             return self._get_transaction_or_raise_exception(id_)
@@ -244,16 +427,91 @@ class TransactionDB:
             self.session.commit()
 
     def _get_transaction_or_raise_exception(self, id_: int):
-        t = self.session.query(Transaction).get(id_)
+        # callers only mutate the transaction after fetching it, so there is
+        # no pending state worth flushing before the query
+        with self.session.no_autoflush:
+            t = self.session.query(Transaction).get(id_)
         if t:
             return t
         else:
             raise TransactionDBException("""
                 transaction doesn't exist in DB (%s)
-                """ % id)
+                """ % id_)
+
+    @staticmethod
+    def _check_updatable_fields(fields: dict):
+        invalid = set(fields) - UPDATABLE_TRANSACTION_FIELDS
+        if invalid:
+            raise TransactionDBException(
+                "Fields can't be updated: {}"
+                .format(', '.join(sorted(invalid))))
+
+    def _update_transaction(self, id_: int, fields: dict):
+        """Set the given fields of the transaction with a single UPDATE
+        statement and commit, without fetching the row first."""
+        if not fields:
+            # an UPDATE without SET clause is a syntax error, which would
+            # be retried as an OperationalError
+            raise TransactionDBException("No fields to update")
+        self._check_updatable_fields(fields)
+        try:
+            rows = self.session.query(Transaction) \
+                .filter_by(transaction_id=id_) \
+                .update(fields, synchronize_session=False)
+            if not rows:
+                raise TransactionDBException(
+                    "transaction doesn't exist in DB ({})".format(id_))
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    @t_db_retry
+    @write_lock
+    def update_transaction(self, id_: int, **fields):
+        """Update several fields of a transaction at once, committing only
+        once. Use this instead of calling several setters back-to-back.
+
+        Only fields in UPDATABLE_TRANSACTION_FIELDS can be updated.
+        TransactionDBException will be thrown for any other field, if no
+        field is given, or if the transaction doesn't exist."""
+        self._update_transaction(id_, fields)
+
+    @t_db_retry
+    @write_lock
+    def update_many(self, updates):
+        """Update the fields of several transactions, committing only once.
+
+        Parameters
+        ----------
+        updates: list
+            List of (transaction id, dict of fields) tuples. Updates for the
+            same transaction id are merged, later ones taking precedence.
+            Transaction ids which don't exist in the DB, and updates without
+            any field, are ignored.
+        """
+        merged = {}
+        for id_, fields in updates:
+            if not fields:
+                continue
+            self._check_updatable_fields(fields)
+            merged.setdefault(id_, {}).update(fields)
+        if not merged:
+            return
+        try:
+            # one UPDATE per transaction, which unlike bulk_update_mappings
+            # doesn't fail the whole batch when an id doesn't match any row
+            for id_, fields in merged.items():
+                self.session.query(Transaction) \
+                    .filter_by(transaction_id=id_) \
+                    .update(fields, synchronize_session=False)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_queued(self,
                    id_: int,
                    last_message: str = None,
@@ -268,19 +526,14 @@ class TransactionDB:
             Transaction ID
         last_message
             stringified JSON metadata to save"""
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.task_state = TaskState.queued
-            t.processing_state = processing_state
-            if last_message:
-                t.last_message = last_message
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        fields = {'task_state': TaskState.queued,
+                  'processing_state': processing_state}
+        if last_message:
+            fields['last_message'] = last_message
+        self._update_transaction(id_, fields)
 
     @t_db_retry
-    @lock
+    @read_lock
     def peek_queued(self, processing_state='waiting', peek_all=False):
         """Peeks the oldest queued transaction from the database, if any.
         Note that this is a peek, not a poll operation, so unless the
@@ -309,12 +562,13 @@ class TransactionDB:
                 Transaction.processing_state == processing_state)
 
         queued = query.order_by(Transaction.transaction_id.asc())
-        if queued:
-            return queued if peek_all else queued.first()
-        return None
+        if peek_all:
+            return queued
+        with self.session.no_autoflush:
+            return queued.limit(1).one_or_none()
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_processing(self,
                        id_: int,
                        new_processing_state: str,
@@ -355,7 +609,7 @@ class TransactionDB:
             raise
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_failed(self, id_: int, cause: str):
         """to be called when a transaction fails. Save error information
         from 'cause'"""
@@ -374,7 +628,7 @@ class TransactionDB:
             raise
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_completed(self, id_: int, clear_error: bool = True):
         """to be called when the transaction completes successfully.
         Error field will be set to '' only if clear_error = True.
@@ -398,130 +652,72 @@ class TransactionDB:
             raise
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_status(self, id_: int, status: str):
         """to be called e.g. when the radiologist visits the results of a study
         in the new platform ('reviewed') or the report is sent to the PACS
         ('sent_to_pacs') ..."""
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.status = status
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        self._update_transaction(id_, {'status': status})
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_skipped(self, id_: int, cause: str = None):
         """to be called when the transaction is skipped. Save skip information
         from 'cause'"""
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.task_skipped = 1
-            if cause:
-                t.error = cause
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        fields = {'task_skipped': 1}
+        if cause:
+            fields['error'] = cause
+        self._update_transaction(id_, fields)
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_cancelled(self, id_: int, cause: str = None):
         """to be called when the transaction is cancelled. Save cancel information
         from 'cause'"""
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.task_cancelled = 1
-            if cause:
-                t.error = cause
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        fields = {'task_cancelled': 1}
+        if cause:
+            fields['error'] = cause
+        self._update_transaction(id_, fields)
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_archived(self, id_: int):
         """to be called when the transaction is archived."""
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.archived = 1
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        self._update_transaction(id_, {'archived': 1})
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_last_message(self, id_: int, last_message: str):
         """Updates the last_message field of the transaction
         with the given string."""
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.last_message = last_message
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        self._update_transaction(id_, {'last_message': last_message})
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_patient_consent(self, id_: int):
         """Mark this transaction ID with data usage patient consent"""
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.patient_consent = 1
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        self._update_transaction(id_, {'patient_consent': 1})
 
     @t_db_retry
-    @lock
+    @write_lock
     def unset_patient_consent(self, id_: int):
         """Mark this transaction ID with NO data usage patient consent"""
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.patient_consent = 0
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        self._update_transaction(id_, {'patient_consent': 0})
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_qa_score(self, id_: int, qa_score):
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.qa_score = qa_score
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        self._update_transaction(id_, {'qa_score': qa_score})
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_billable(self, id_: int, billable):
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.billable = billable
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        self._update_transaction(id_, {'billable': billable})
 
     @t_db_retry
-    @lock
+    @write_lock
     def set_priority(self, id_: int, priority):
-        try:
-            t = self._get_transaction_or_raise_exception(id_)
-            t.priority = priority
-            self.session.commit()
-        except Exception:
-            self.session.rollback()
-            raise
+        self._update_transaction(id_, {'priority': priority})
 
     @t_db_retry
     def add_user(self, name, password):
@@ -542,11 +738,15 @@ class TransactionDB:
             user.name = name
             user.hashed_password = user.password_hash(password)
             self.session.add(user)
+            # take the id before committing, so that nothing runs after the
+            # commit and the session doesn't keep a transaction open
+            self.session.flush()
+            user_id = user.id
             self.session.commit()
-            user = self.session.query(User).filter_by(name=name).first()
-            return user.id
-        finally:
+            return user_id
+        except Exception:
             self.session.rollback()
+            raise
 
     @t_db_retry
     def add_role(self, role_id: str, role_description: str,
@@ -566,8 +766,9 @@ class TransactionDB:
             role.permissions = permissions
             self.session.add(role)
             self.session.commit()
-        finally:
+        except Exception:
             self.session.rollback()
+            raise
 
     def __pre_conditions_user_role(self, user_id, role_id):
         user = self.session.query(User).get(user_id)
@@ -612,8 +813,9 @@ class TransactionDB:
             user_role.user_id = user_id
             self.session.add(user_role)
             self.session.commit()
-        finally:
+        except Exception:
             self.session.rollback()
+            raise
 
     @t_db_retry
     def revoke_user_role(self, user_id: int, role_id: str):
@@ -640,8 +842,9 @@ class TransactionDB:
 
             self.session.delete(user_role)
             self.session.commit()
-        finally:
+        except Exception:
             self.session.rollback()
+            raise
 
     @t_db_retry
     def remove_user(self, user_id: int):
@@ -652,8 +855,9 @@ class TransactionDB:
                 raise TransactionDBException("The user doesn't exist")
             self.session.delete(user)
             self.session.commit()
-        finally:
+        except Exception:
             self.session.rollback()
+            raise
 
     @t_db_retry
     def set_user_preferences(self, user_id: int, preferences: dict):
@@ -676,10 +880,12 @@ class TransactionDB:
                                              .format(key))
 
             self.session.commit()
-        finally:
+        except Exception:
             self.session.rollback()
+            raise
 
     @t_db_retry
+    @read_lock
     def get_user_preferences(self, user_id: int) -> dict:
         """Return a dict with the user preferences,
         or None if no special prefs. set for this user"""
@@ -689,6 +895,8 @@ class TransactionDB:
                 return prefs.to_dict()
             return None
         finally:
+            # end the transaction, so that the next read isn't served
+            # from a stale identity map
             self.session.rollback()
 
     @t_db_retry
@@ -702,6 +910,20 @@ class TransactionDB:
         Throws TransactionDBException if metadata for this study was
         already added before."""
         try:
+            if self.session.bind.dialect.name == 'sqlite':
+                # a single statement instead of SELECT + INSERT / UPDATE
+                result = self.session.execute(
+                    insert(StudiesMetadata.__table__)
+                    .prefix_with('OR REPLACE' if overwrite else 'OR IGNORE')
+                    .values(study_id=study_id,
+                            origin=origin,
+                            c_move_time=c_move_time))
+                if not result.rowcount:
+                    raise TransactionDBException((
+                        "Study was already sent to mdbrain. "))
+                self.session.commit()
+                return
+
             md = self.session.query(StudiesMetadata)\
                 .filter_by(study_id=study_id).first()
             if md and not overwrite:
@@ -715,18 +937,22 @@ class TransactionDB:
             md.c_move_time = c_move_time
             self.session.add(md)
             self.session.commit()
-        finally:
+        except Exception:
             self.session.rollback()
+            raise
 
     @t_db_retry
+    @read_lock
     def get_study_metadata(self, study_id: str) -> StudiesMetadata:
         try:
             return self.session.query(StudiesMetadata)\
                 .filter_by(study_id=study_id).first()
         finally:
+            # see get_transaction
             self.session.commit()
 
     @t_db_retry
+    @read_lock
     def get_user_sites(self, user_id: int):  # TODO -> Query[UserSite]:
         """Get all sites a user is associated with via `UserSite`s.
 
@@ -734,12 +960,9 @@ class TransactionDB:
         a list of IDs, use
         `[us.site_id for us in t_db.get_user_sites(user_id)]`.
         """
-        try:
-            return (self.session
-                    .query(UserSite)
-                    .filter_by(user_id=user_id))
-        finally:
-            self.session.commit()
+        return (self.session
+                .query(UserSite)
+                .filter_by(user_id=user_id))
 
     @t_db_retry
     def set_user_sites(self, user_id: int, site_ids: List[int]):
@@ -748,13 +971,15 @@ class TransactionDB:
         This replaces all exisiting associations.
         """
         try:
-            self.get_user_sites(user_id).delete()
-            for site_id in site_ids:
-                user_site = UserSite(user_id=user_id, site_id=site_id)
-                self.session.add(user_site)
+            self.get_user_sites(user_id).delete(synchronize_session=False)
+            self.session.bulk_insert_mappings(
+                UserSite,
+                [{'user_id': user_id, 'site_id': site_id}
+                 for site_id in site_ids])
             self.session.commit()
-        finally:
+        except Exception:
             self.session.rollback()
+            raise
 
     def close(self):
         self.session.close()
@@ -16,5 +16,8 @@ setup(
         'SQLAlchemy',
         'passlib',
         'tenacity'
-    ]
+    ],
+    extras_require={
+        'orjson': ['orjson']
+    }
 )
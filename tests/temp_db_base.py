@@ -12,10 +12,12 @@ class TempDBFactory():
         self.test_suite_name = test_suite_name
         self.test_index = 0
         self.temp_folder = None
+        self.temp_folders = []
 
     def get_temp_db(self):
         self.temp_folder = \
             tempfile.mkdtemp(suffix='_{}_'.format(self.test_suite_name))
+        self.temp_folders.append(self.temp_folder)
         self.test_index += 1
         return create_engine(
             'sqlite:///{}?check_same_thread=False'
@@ -24,6 +26,8 @@ class TempDBFactory():
         )
 
     def delete_temp_folder(self):
-        if self.temp_folder:
-            shutil.rmtree(self.temp_folder)
-            self.temp_folder = None
+        """Delete the folders of all databases created so far"""
+        for temp_folder in self.temp_folders:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+        self.temp_folders = []
+        self.temp_folder = None
@@ -5,7 +5,11 @@ import mock
 import shutil
 import time
 import itertools
+import fnmatch
 import os
+from collections import namedtuple
+
+from pyfakefs import fake_filesystem_unittest
 
 from mediaire_toolbox.data_cleaner import DataCleaner
 
@@ -13,6 +17,49 @@ logging.basicConfig(format='%(asctime)s %(levelname)s  %(module)s:%(lineno)s '
                     '%(message)s', level=logging.DEBUG)
 
 
+class StatCache:
+    """Fake file stats of a directory tree, to be used by mocking os.scandir
+    with the scandir method as side effect. The directory entries take their
+    stats from the cache. Files that were forgotten, or never set, don't
+    exist."""
+    def __init__(self, stats_by_path=None):
+        self._stats = {}
+        for path, (ctime, size) in (stats_by_path or {}).items():
+            self.set(path, ctime, size)
+
+    def set(self, path, ctime, size):
+        self._stats[path] = mock.Mock(st_ctime=ctime, st_size=size)
+
+    def forget(self, path):
+        """Simulate that the file was deleted"""
+        self._stats.pop(path, None)
+
+    def stat(self, path):
+        try:
+            return self._stats[path]
+        except KeyError:
+            raise FileNotFoundError(path)
+
+    def scandir(self, path):
+        prefix = path + '/'
+        names = []
+        for file in sorted(self._stats):
+            if file.startswith(prefix):
+                name = file[len(prefix):].split('/')[0]
+                if name not in names:
+                    names.append(name)
+        return [self._entry(prefix + name) for name in names]
+
+    def _entry(self, path):
+        entry = mock.Mock()
+        entry.name = os.path.basename(path)
+        entry.is_file.return_value = path in self._stats
+        entry.is_dir.return_value = path not in self._stats
+        entry.stat.side_effect = \
+            lambda follow_symlinks=True: self.stat(path)
+        return entry
+
+
 class TestDataCleaner(unittest.TestCase):
     """Test protected member functions"""
     def test_check_valid_init_raise(self):
@@ -23,18 +70,48 @@ class TestDataCleaner(unittest.TestCase):
             None, 0, 0, 0, -1,
             None, ['*.nii'], ['test.nii'])
 
-    def test__creation_time_and_size(self):
-        class mock_class():
-            def __init__(self, time, size):
-                self.st_ctime = time
-                self.st_size = size
-        with mock.patch('os.stat') as mock_stat:
-            mock_stat.return_value = mock_class('time', 'size')
+    def test__scan_dir_stats_entry_stat(self):
+        with mock.patch('os.scandir') as mock_scandir:
+            mock_scandir.side_effect = StatCache(
+                {'base/file1': ('time', 'size')}).scandir
             self.assertEqual(
-                ('file1', 'time', 'size'),
-                DataCleaner._creation_time_and_size('file1')
+                [('base/file1', 'time', 'size')],
+                DataCleaner._scan_dir_stats('base')
             )
 
+    def test__scan_dir_stats_subfolders(self):
+        stat_cache = StatCache({
+            'base/folder1/file1': (1, 10),
+            'base/folder1/file2': (2, 20),
+            'base/folder2/file3': (3, 30)})
+        with mock.patch('os.scandir', side_effect=stat_cache.scandir):
+            self.assertEqual(
+                [('base/folder1/file1', 1, 10), ('base/folder1/file2', 2, 20),
+                 ('base/folder2/file3', 3, 30)],
+                DataCleaner._scan_dir_stats('base')
+            )
+
+    def test__scan_dir_stats_deleted_file(self):
+        """Files deleted between scanning and stat are left out"""
+        stat_cache = StatCache({
+            'base/folder1/file1': (1, 10),
+            'base/folder1/file2': (2, 20)})
+
+        def scandir_then_delete(path):
+            entries = stat_cache.scandir(path)
+            stat_cache.forget('base/folder1/file1')
+            return entries
+
+        with mock.patch('os.scandir', side_effect=scandir_then_delete):
+            self.assertEqual(
+                [('base/folder1/file2', 2, 20)],
+                DataCleaner._scan_dir_stats('base'))
+        stat_cache.set('base/folder1/file1', 3, 30)
+        with mock.patch('os.scandir', side_effect=stat_cache.scandir):
+            self.assertEqual(
+                [('base/folder1/file1', 3, 30), ('base/folder1/file2', 2, 20)],
+                DataCleaner._scan_dir_stats('base'))
+
     def test__sum_filestat_list_1(self):
         self.assertEqual(0, DataCleaner._sum_filestat_list([]))
 
@@ -99,31 +176,54 @@ class TestDataCleaner(unittest.TestCase):
     def test__fnmatch_3(self):
         self.assertFalse(DataCleaner._fnmatch('test.nii', ['*.dcm']))
 
-    def test__check_remove_filter(self):
-        self.assertFalse(DataCleaner._check_remove_filter(
-            'test.nii', [], []))
-
-    def test__check_remove_filter2(self):
-        self.assertFalse(
-            DataCleaner._check_remove_filter('test.nii', ['*.dcm'], []))
+    def test__fnmatch_many_patterns(self):
+        patterns = ['*.dcm', '*.nii', '*.nii.gz', '*.png', '*.jpg', '*.json',
+                    'report_?.pdf', '[ab]*.txt', '*/tmp/*', 'old_*',
+                    '*[!0-9].log']
+        for file in ['a.dcm', 'folder/b.nii.gz', 'report_1.pdf',
+                     'report_12.pdf', 'a.txt', 'c.txt', 'x/tmp/y', 'old_x',
+                     'new_x', 'error.log', 'error1.log', 'test.NII']:
+            with self.subTest(file=file):
+                self.assertEqual(
+                    any(fnmatch.fnmatch(file, p) for p in patterns),
+                    DataCleaner._fnmatch(file, patterns))
 
-    def test__check_remove_filter3(self):
-        self.assertTrue(
-            DataCleaner._check_remove_filter('test.nii', [], ['*.nii']))
-
-    def test__check_remove_filter4(self):
-        self.assertFalse(DataCleaner._check_remove_filter(
-            'test.nii', None, None))
-
-    def test__check_remove_filter5(self):
-        """Both whitelist and blacklist"""
-        self.assertFalse(DataCleaner._check_remove_filter(
-            'test.nii', ['test.nii'], ['*.nii']))
-
-    def test__check_remove_filter6(self):
-        """Both whitelist and blacklist"""
-        self.assertTrue(DataCleaner._check_remove_filter(
-            'test.nii', ['not_test.nii'], ['*.nii']))
+    def test__check_remove_filter(self):
+        """NOTE whitelist has priority over blacklist"""
+        for file, whitelist, blacklist, expected in [
+                # no blacklist, nothing is removed
+                ('test.nii', [], [], False),
+                ('test.nii', None, None, False),
+                ('test.nii', ['*.dcm'], [], False),
+                ('test.nii', [], ['*.nii'], True),
+                # both whitelist and blacklist
+                ('test.nii', ['test.nii'], ['*.nii'], False),
+                ('test.nii', ['not_test.nii'], ['*.nii'], True),
+                # any of the patterns matches
+                ('test.nii', [], ['*.dcm', '*.png', '*.nii'], True),
+                ('a/b.dcm', ['*.json', 'a/*'], ['*.dcm'], False),
+                # matching is case sensitive
+                ('test.NII', [], ['*.nii'], False),
+                # patterns match the whole path
+                ('folder/test.nii', [], ['test.nii'], False),
+                ('folder/test.nii', [], ['*/test.nii'], True),
+                ('folder/test.nii', [], ['folder*'], True),
+                ('test.nii.gz', [], ['*.nii'], False),
+                # single characters and character classes
+                ('0001.dcm', [], ['000?.dcm'], True),
+                ('00010.dcm', [], ['000?.dcm'], False),
+                ('a.dcm', [], ['[ab].dcm'], True),
+                ('c.dcm', [], ['[ab].dcm'], False),
+                ('c.dcm', [], ['[!ab].dcm'], True),
+                ('report_1.pdf', ['*_[0-9].pdf'], ['*.pdf'], False),
+                # empty patterns only match the empty string
+                ('test.nii', [''], ['*'], True)]:
+            with self.subTest(file=file, whitelist=whitelist,
+                              blacklist=blacklist):
+                self.assertEqual(
+                    expected,
+                    DataCleaner._check_remove_filter(
+                        file, whitelist, blacklist))
 
     """Test public functions"""
 
@@ -251,73 +351,99 @@ class TestDataCleaner(unittest.TestCase):
             filelist, 15, ['file1'], 'file*')
         self.assertEqual([('file2', 0, 10), ('file3', 0, 10)], removed)
 
+    def test_clean_files_by_size_stops_early(self):
+        """Files after the size requirement is met are not matched"""
+        for whitelist in [None, ['1.dcm']]:
+            with self.subTest(whitelist=whitelist):
+                consumed = []
+
+                def filelist():
+                    for i in range(10000):
+                        consumed.append(i)
+                        yield ('{}.dcm'.format(i), 0, 1024)
+
+                removed = DataCleaner.clean_files_by_size_optimized(
+                    filelist(), 5 * 1024, whitelist, '*.dcm')
+                self.assertEqual(6, len(removed))
+                self.assertLessEqual(len(consumed), 7)
+
     def test_remove_files_file_nonexistent(self):
         fail_list = DataCleaner.remove_files(
             [('mockpath/that/does/not/exist', 0, 0)])
         self.assertEqual(['mockpath/that/does/not/exist'], fail_list)
 
-    def test_remove_empty_folder_from_base_folder_1(self):
-        try:
-            base_folder = tempfile.mkdtemp()
-            removed = DataCleaner.remove_empty_folder_from_base_folder(
-                base_folder)
-            self.assertEqual([], removed)
-        finally:
-            shutil.rmtree(base_folder)
+    def test_scalability(self):
+        # test that the function does not take too long
+        list_of_folders = [str(i) for i in range(100)]
 
-    def test_remove_empty_folder_from_base_folder_2(self):
-        try:
-            base_folder = tempfile.mkdtemp()
-            tmp1 = tempfile.mkdtemp(dir=base_folder)
-            tmp2 = tempfile.mkdtemp(dir=base_folder)
-            tmp3 = tempfile.mkdtemp(dir=tmp1)
-            tempfile.mkstemp(dir=tmp2)
-            removed = DataCleaner.remove_empty_folder_from_base_folder(base_folder)
-            self.assertEqual([tmp3, tmp1], removed)
-        finally:
-            shutil.rmtree(base_folder)
-
-    def test_clean_up_priority_list(self):
-        with mock.patch.object(DataCleaner, 'scan_dir'), \
-                mock.patch.object(DataCleaner, '_get_file_stats') as mock_files, \
-                mock.patch.object(DataCleaner, '_get_current_time') as mock_time:
-            mock_files.return_value = [
-                ('file1', 15, 30),
-                ('file2', 5, 10),
-                ('file3', 11, 30),
-                ('file4', 13, 30)
-            ]
-            mock_time.return_value = 20
-            dc_instance = DataCleaner(
-                folder='',
+        dcm_files = ['{}.dcm'.format(i) for i in range(200)]
+
+        filelist = [
+            (os.path.join(a, b), 0, 1)
+            for a, b in itertools.product(list_of_folders, dcm_files)]
+
+        s_time = time.time()
+        DataCleaner.clean_files_by_size_per_folder(
+            filelist, reduce_size=100000000, pattern='*dcm')
+        e_time = time.time()
+        self.assertLess(e_time - s_time, 1.2)
+
+    def test_scalability_2(self):
+        # test that the function does not take too long
+        list_of_folders = [str(i) for i in range(100)]
+
+        dcm_files = ['{}.dcm'.format(i) for i in range(200)]
+
+        filelist = [
+            (os.path.join(a, b), 0, 1)
+            for a, b in itertools.product(list_of_folders, dcm_files)]
+
+        s_time = time.time()
+        DataCleaner.clean_files_by_size_optimized(
+            filelist, reduce_size=100000000, pattern='*dcm')
+        e_time = time.time()
+        self.assertLess(e_time - s_time, 1.2)
+
+
+CleanUpCase = namedtuple(
+    'CleanUpCase', ['name', 'filestats', 'data_cleaner_args', 'expected'])
+
+
+class TestDataCleanerCleanUp(unittest.TestCase):
+    """Test clean_up on mocked file stats"""
+    FILESTATS = [
+        ('file1', 15, 30),
+        ('file2', 5, 10),
+        ('file3', 11, 30),
+        ('file4', 13, 30)
+    ]
+    CURRENT_TIME = 20
+
+    CASES = [
+        CleanUpCase(
+            name='priority_list',
+            filestats=FILESTATS,
+            data_cleaner_args=dict(
                 folder_size_soft_limit=1.0*50/1024/1028,
                 folder_size_hard_limit=1.0*50/1024/1028,
                 max_data_seconds=10,
                 whitelist=['file1', 'file3'],
-                priority_list=['file2', 'file4', 'file*']
-            )
-            removed = dc_instance.clean_up(dry_run=True)
+                priority_list=['file2', 'file4', 'file*']),
             # TODO file should be deleted only once
-            self.assertEqual(
-                [('file2', 5, 10),
-                 ('file4', 13, 30),
-                 ('file4', 13, 30)],
-                removed
-            )
-
-    def test_clean_up_priority_list_2(self):
-        with mock.patch.object(DataCleaner, 'scan_dir'), \
-                mock.patch.object(DataCleaner, '_get_file_stats') as mock_files, \
-                mock.patch.object(DataCleaner, '_get_current_time') as mock_time:
-            # test that 1. files not in priority_list are not removed
-            #    (t.db not removed)
-            # 2. files removed are in the order of the priority list
-            #    (old*.nii removed first)
-            # 3. files on the whitelist are not removed
-            #    (not removing file1.nii and file3.nii)
-            # 4. stop the removing process early if size requirements met
-            #    (0004.dcm not removed)
-            mock_files.return_value = [
+            expected=[('file2', 5, 10),
+                      ('file4', 13, 30),
+                      ('file4', 13, 30)]),
+        # test that 1. files not in priority_list are not removed
+        #    (t.db not removed)
+        # 2. files removed are in the order of the priority list
+        #    (old*.nii removed first)
+        # 3. files on the whitelist are not removed
+        #    (not removing file1.nii and file3.nii)
+        # 4. stop the removing process early if size requirements met
+        #    (0004.dcm not removed)
+        CleanUpCase(
+            name='priority_list_2',
+            filestats=[
                 ('folder1/0001.png', 0, 10),
                 ('folder1/0002.png', 0, 10),
                 ('folder1/0003.png', 0, 10),
@@ -326,33 +452,21 @@ class TestDataCleaner(unittest.TestCase):
                 ('folder1/folder2/old_file2.nii', 10, 30),
                 ('folder1/folder2/old_file3.nii', 10, 30),
                 ('folder1/folder2/file4.nii', 10, 30),
-                ('folder2/t.db', 10, 40),
-
-            ]
-            mock_time.return_value = 20
-            dc_instance = DataCleaner(
-                folder='',
+                ('folder2/t.db', 10, 40)],
+            data_cleaner_args=dict(
                 folder_size_soft_limit=1.0*115/1024/1024,
                 folder_size_hard_limit=1.0*115/1024/1024,
                 max_data_seconds=-1,
                 whitelist=['*file1.nii', '*file3.nii'],
-                priority_list=['*old*.nii', '*nii', '*.png', 'file*']
-            )
-            removed = dc_instance.clean_up(dry_run=True)
+                priority_list=['*old*.nii', '*nii', '*.png', 'file*']),
             # TODO file should be ideally deleted only once
-            self.assertEqual(
-                [('folder1/folder2/old_file2.nii', 10, 30),
-                 ('folder1/folder2/file4.nii', 10, 30),
-                 ('folder1/folder2/old_file2.nii', 10, 30)],
-                removed
-            )
-
-    def test_clean_up_priority_list_3_dcms(self):
-        with mock.patch.object(DataCleaner, 'scan_dir'), \
-                mock.patch.object(DataCleaner, '_get_file_stats') as mock_files, \
-                mock.patch.object(DataCleaner, '_get_current_time') as mock_time:
-            # test that 1. dcm files are removed on a whole
-            mock_files.return_value = [
+            expected=[('folder1/folder2/old_file2.nii', 10, 30),
+                      ('folder1/folder2/file4.nii', 10, 30),
+                      ('folder1/folder2/old_file2.nii', 10, 30)]),
+        # test that 1. dcm files are removed on a whole
+        CleanUpCase(
+            name='priority_list_3_dcms',
+            filestats=[
                 ('folder1/0001.dcm', 0, 10),
                 ('folder1/0002.dcm', 0, 10),
                 ('folder1/0003.dcm', 0, 10),
@@ -362,131 +476,186 @@ class TestDataCleaner(unittest.TestCase):
                 ('folder2/folder3/file1.nii', 10, 10),
                 ('folder3/0001.dcm', 5, 10),
                 ('folder3/0002.dcm', 5, 10),
-                ('folder3/t.db', 10, 10),
-
-            ]
-            mock_time.return_value = 20
-            dc_instance = DataCleaner(
-                folder='',
+                ('folder3/t.db', 10, 10)],
+            data_cleaner_args=dict(
                 folder_size_soft_limit=1.0*55/1024/1024,
                 folder_size_hard_limit=1.0*55/1024/1024,
                 max_data_seconds=-1,
                 whitelist=[],
-                priority_list=['*.dcm']
-            )
-            removed = dc_instance.clean_up(dry_run=True)
-            self.assertEqual(
-                [('folder1/0001.dcm', 0, 10),
-                 ('folder1/0002.dcm', 0, 10),
-                 ('folder1/0003.dcm', 0, 10),
-                 ('folder1/0004.dcm', 0, 10),
-                 ('folder3/0001.dcm', 5, 10),
-                 ('folder3/0002.dcm', 5, 10)],
-                removed
-            )
-
-    def test_do_not_clean_young_files(self):
-        with mock.patch.object(DataCleaner, 'scan_dir'), \
-                mock.patch.object(DataCleaner, '_get_file_stats') as mock_files, \
-                mock.patch.object(DataCleaner, '_get_current_time') as mock_time:
-            mock_files.return_value = [
-                ('file1', 15, 30),
-                ('file2', 5, 10),
-                ('file3', 11, 30),
-                ('file4', 13, 30)
-            ]
-            mock_time.return_value = 20
-            # file2 is 15 seconds old
-            # file4 is 7 seconds old
-            dc_instance = DataCleaner(
-                folder='',
+                priority_list=['*.dcm']),
+            expected=[('folder1/0001.dcm', 0, 10),
+                      ('folder1/0002.dcm', 0, 10),
+                      ('folder1/0003.dcm', 0, 10),
+                      ('folder1/0004.dcm', 0, 10),
+                      ('folder3/0001.dcm', 5, 10),
+                      ('folder3/0002.dcm', 5, 10)]),
+        # file2 is 15 seconds old
+        # file4 is 7 seconds old
+        CleanUpCase(
+            name='do_not_clean_young_files',
+            filestats=FILESTATS,
+            data_cleaner_args=dict(
                 folder_size_soft_limit=1024*1024,
                 folder_size_hard_limit=1024*1024,
                 max_data_seconds=10,
                 whitelist=['file1', 'file3'],
                 blacklist=['file*'],
-                min_data_seconds=8
-            )
-            removed = dc_instance.clean_up(dry_run=True)
-            self.assertEqual([('file2', 5, 10)], removed)
-
-    def test_soft_hard_limit(self):
-        with mock.patch.object(DataCleaner, 'scan_dir'), \
-                mock.patch.object(DataCleaner, '_get_file_stats') as mock_files, \
-                mock.patch.object(DataCleaner, '_get_current_time') as mock_time:
-            mock_files.return_value = [
-                ('file1', 15, 30),
-                ('file2', 5, 10),
-                ('file3', 11, 30),
-                ('file4', 13, 30)
-            ]
-            mock_time.return_value = 20
-            dc_instance = DataCleaner(
-                folder='',
+                min_data_seconds=8),
+            expected=[('file2', 5, 10)]),
+        CleanUpCase(
+            name='soft_hard_limit',
+            filestats=FILESTATS,
+            data_cleaner_args=dict(
                 folder_size_soft_limit=1.0*40/1024/1028,
                 folder_size_hard_limit=1.0*50/1024/1028,
                 max_data_seconds=-1,
                 whitelist=[''],
-                priority_list=['file*']
-            )
-            removed = dc_instance.clean_up(dry_run=True)
-            self.assertEqual(
-                [('file2', 5, 10),
-                 ('file3', 11, 30),
-                 ('file4', 13, 30)],
-                removed
-            )
-
-    def test_soft_hard_limit_2(self):
-        with mock.patch.object(DataCleaner, 'scan_dir'), \
-                mock.patch.object(DataCleaner, '_get_file_stats') as mock_files, \
-                mock.patch.object(DataCleaner, '_get_current_time') as mock_time:
-            mock_files.return_value = [
-                ('file1', 15, 30),
-                ('file2', 5, 10),
-                ('file3', 11, 30),
-                ('file4', 13, 30)
-            ]
-            mock_time.return_value = 20
-            dc_instance = DataCleaner(
-                folder='',
+                priority_list=['file*']),
+            expected=[('file2', 5, 10),
+                      ('file3', 11, 30),
+                      ('file4', 13, 30)]),
+        CleanUpCase(
+            name='soft_hard_limit_2',
+            filestats=FILESTATS,
+            data_cleaner_args=dict(
                 folder_size_soft_limit=1.0*40/1024/1028,
                 folder_size_hard_limit=1.0*110/1024/1028,
                 max_data_seconds=-1,
                 whitelist=[''],
-                priority_list=['file*']
-            )
+                priority_list=['file*']),
+            expected=[]),
+    ]
+
+    def test_clean_up(self):
+        for case in self.CASES:
+            with self.subTest(name=case.name):
+                dc_instance = DataCleaner(
+                    folder='',
+                    scan_fn=lambda folder: list(case.filestats),
+                    time_fn=lambda: self.CURRENT_TIME,
+                    **case.data_cleaner_args)
+                removed = dc_instance.clean_up(dry_run=True)
+                self.assertEqual(case.expected, removed)
+
+    def test_clean_up_default_scan_and_time(self):
+        case = self.CASES[0]
+        with mock.patch.object(DataCleaner, '_scan_dir_stats',
+                               return_value=list(case.filestats)) as scan, \
+                mock.patch.object(DataCleaner, '_get_current_time',
+                                  return_value=self.CURRENT_TIME) as now:
+            dc_instance = DataCleaner('base', **case.data_cleaner_args)
             removed = dc_instance.clean_up(dry_run=True)
-            self.assertEqual([], removed)
-
-    def test_scalability(self):
-        # test that the function does not take too long
-        list_of_folders = [str(i) for i in range(100)]
-
-        dcm_files = ['{}.dcm'.format(i) for i in range(200)]
-
-        filelist = [
-            (os.path.join(a, b), 0, 1)
-            for a, b in itertools.product(list_of_folders, dcm_files)]
-
-        s_time = time.time()
-        DataCleaner.clean_files_by_size_per_folder(
-            filelist, reduce_size=100000000, pattern='*dcm')
-        e_time = time.time()
-        self.assertLess(e_time - s_time, 1.2)
-
-    def test_scalability_2(self):
-        # test that the function does not take too long
-        list_of_folders = [str(i) for i in range(100)]
-
-        dcm_files = ['{}.dcm'.format(i) for i in range(200)]
+        self.assertEqual(case.expected, removed)
+        scan.assert_called_once_with('base')
+        # the time is taken once, not per file
+        now.assert_called_once_with()
+
+
+class TestDataCleanerScanDir(unittest.TestCase):
+    """Test walking directory trees on the real file system"""
+    @classmethod
+    def setUpClass(cls):
+        # create the temporary files in memory where available
+        cls.old_tempdir = tempfile.tempdir
+        cls.shm_tempdir = None
+        if os.path.isdir('/dev/shm'):
+            try:
+                cls.shm_tempdir = tempfile.mkdtemp(dir='/dev/shm',
+                                                   prefix='mt_')
+                tempfile.tempdir = cls.shm_tempdir
+            except OSError:
+                pass
+
+    @classmethod
+    def tearDownClass(cls):
+        tempfile.tempdir = cls.old_tempdir
+        if cls.shm_tempdir:
+            shutil.rmtree(cls.shm_tempdir, ignore_errors=True)
+
+    def setUp(self):
+        self.base_folder = tempfile.mkdtemp(suffix='_test_data_cleaner')
+        self.addCleanup(shutil.rmtree, self.base_folder)
+        sub_folder = tempfile.mkdtemp(dir=self.base_folder)
+        self.folders = [self.base_folder, sub_folder,
+                        tempfile.mkdtemp(dir=sub_folder)]
+        for i in range(100):
+            fd, _ = tempfile.mkstemp(dir=self.folders[i % 3])
+            os.write(fd, b'x' * i)
+            os.close(fd)
+
+    def test__scan_dir_stats(self):
+        expected = [(path, os.stat(path).st_ctime, os.stat(path).st_size)
+                    for path in DataCleaner.scan_dir(self.base_folder)]
+        with mock.patch('os.scandir', wraps=os.scandir) as mock_scandir, \
+                mock.patch('os.stat', wraps=os.stat) as mock_stat:
+            filestats = DataCleaner._scan_dir_stats(self.base_folder)
+
+        self.assertEqual(sorted(expected), sorted(filestats))
+        self.assertEqual(100, len(filestats))
+        # DirEntry.stat issues its lstat in C, which the mock can't see. This
+        # only guards against falling back to os.stat per file
+        self.assertEqual(0, mock_stat.call_count)
+        self.assertEqual(len(self.folders), mock_scandir.call_count)
 
-        filelist = [
-            (os.path.join(a, b), 0, 1)
-            for a, b in itertools.product(list_of_folders, dcm_files)]
+    def test_remove_empty_folder_from_base_folder_1(self):
+        base_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_folder)
+        removed = DataCleaner.remove_empty_folder_from_base_folder(
+            base_folder)
+        self.assertEqual([], removed)
 
-        s_time = time.time()
-        DataCleaner.clean_files_by_size_optimized(
-            filelist, reduce_size=100000000, pattern='*dcm')
-        e_time = time.time()
-        self.assertLess(e_time - s_time, 1.2)
+    def test_remove_empty_folder_from_base_folder_2(self):
+        # the folders are removed while os.scandir iterates over them,
+        # which the fake file system of pyfakefs 4 doesn't support
+        base_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_folder)
+        tmp1 = tempfile.mkdtemp(dir=base_folder)
+        tmp2 = tempfile.mkdtemp(dir=base_folder)
+        tmp3 = tempfile.mkdtemp(dir=tmp1)
+        fd, _ = tempfile.mkstemp(dir=tmp2)
+        os.close(fd)
+        removed = DataCleaner.remove_empty_folder_from_base_folder(base_folder)
+        self.assertEqual([tmp3, tmp1], removed)
+        self.assertEqual([os.path.basename(tmp2)], os.listdir(base_folder))
+
+
+class TestDataCleanerFileSystem(fake_filesystem_unittest.TestCase):
+    """Test functions operating on the file system, which is faked in
+    memory"""
+    def setUp(self):
+        self.setUpPyfakefs()
+
+    def test_remove_files(self):
+        _, path = tempfile.mkstemp()
+        fail_list = DataCleaner.remove_files(
+            [(path, 0, 0), ('mockpath/that/does/not/exist', 0, 0)])
+        self.assertEqual(['mockpath/that/does/not/exist'], fail_list)
+        self.assertFalse(os.path.exists(path))
+
+    def test_clean_up_filters(self):
+        base_folder = tempfile.mkdtemp()
+        names = ['{}/{}.{}'.format(folder, i, extension)
+                 for folder in ['study1', 'study2', 'study2/keep']
+                 for i in range(10)
+                 for extension in ['dcm', 'nii', 'DCM']]
+        for name in names:
+            self.fs.create_file(os.path.join(base_folder, name))
+        dc_instance = DataCleaner(
+            base_folder, -1, -1, max_data_seconds=10,
+            whitelist=['*/keep/*'], blacklist=['*.dcm'],
+            time_fn=lambda: time.time() + 100)
+
+        removed = dc_instance.clean_up()
+
+        expected_removed = [
+            name for name in names
+            if name.endswith('.dcm') and '/keep/' not in name]
+        self.assertEqual(
+            sorted(os.path.join(base_folder, name)
+                   for name in expected_removed),
+            sorted(file for file, _, _ in removed))
+        for name in names:
+            with self.subTest(name=name):
+                self.assertEqual(
+                    name not in expected_removed,
+                    os.path.exists(os.path.join(base_folder, name)))
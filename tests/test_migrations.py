@@ -1,19 +1,25 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 import tempfile
 import shutil
 import json
 import os
+import sqlite3
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.schema import MetaData
 
+from mediaire_toolbox.constants import (TRANSACTIONS_DB_SCHEMA_NAME,
+                                        TRANSACTIONS_DB_SCHEMA_VERSION)
 from mediaire_toolbox.transaction_db import migrations
 from mediaire_toolbox.transaction_db.transaction_db import (
     TransactionDB,
     get_transaction_model,
+    get_schema_checksum,
+    TRANSACTIONS_SCHEMA_CHECKSUM,
 )
-from mediaire_toolbox.transaction_db.model import Transaction
+from mediaire_toolbox.transaction_db.model import Transaction, SchemaVersion
 
 
 class TestMigration(unittest.TestCase):
@@ -32,6 +38,12 @@ class TestMigration(unittest.TestCase):
                                           't' + str(test_index) + '.db') +
                              '?check_same_thread=False')
 
+    def test_get_transaction_model(self):
+        engine = self._get_temp_db(1)
+        t_db = TransactionDB(engine)
+        self.assertIs(Transaction, get_transaction_model(engine))
+        t_db.close()
+
     def test_migrate_institution(self):
         engine = self._get_temp_db(2)
         t_db = TransactionDB(engine)
@@ -281,6 +293,210 @@ class TestMigration(unittest.TestCase):
         t_new = t_db.get_transaction(t_id_new)
         self.assertEqual(t_new.site_id, 0)
 
+    def test_migrations_task_progress_and_status(self):
+        """Test that progress and status are derived from processing_state."""
+        temp_folder = tempfile.mkdtemp(suffix='_test_migrations_status')
+        self.addCleanup(shutil.rmtree, temp_folder)
+        temp_db_path = os.path.join(temp_folder, 't_v1.db')
+        shutil.copy('tests/fixtures/t_v1.db', temp_db_path)
+        engine = create_engine('sqlite:///' + temp_db_path)
+        t_db = TransactionDB(engine, create_db=True, db_file_path=temp_db_path)
+
+        progress = {'spm_lesion': 10, 'spm_volumetry': 10,
+                    'volumetry_assessment': 80, 'report': 90,
+                    'send_to_pacs': 100}
+        for migrated_t in t_db.session.query(Transaction):
+            with self.subTest(t_id=migrated_t.transaction_id):
+                state = migrated_t.processing_state
+                self.assertEqual(migrated_t.task_progress,
+                                 progress.get(state, 0))
+                if state is None:
+                    self.assertIsNone(migrated_t.status)
+                elif state == 'send_to_pacs':
+                    self.assertEqual(migrated_t.status, 'sent_to_pacs')
+                else:
+                    self.assertEqual(migrated_t.status, 'unseen')
+
+    def _get_fixture_db(self, suffix):
+        temp_folder = tempfile.mkdtemp(suffix=suffix)
+        self.addCleanup(shutil.rmtree, temp_folder)
+        temp_db_path = os.path.join(temp_folder, 't_v1.db')
+        shutil.copy('tests/fixtures/t_v1.db', temp_db_path)
+        return temp_db_path, create_engine('sqlite:///' + temp_db_path)
+
+    def test_sqlite_journal_mode_untouched(self):
+        """Test that sqlite_pragmas={'journal_mode': None} leaves the journal
+        mode of the database file as it is, also when migrating it."""
+        temp_db_path, engine = self._get_fixture_db('_test_journal_mode')
+        t_db = TransactionDB(engine, db_file_path=temp_db_path,
+                             sqlite_pragmas={'journal_mode': None})
+        self.assertEqual(
+            TRANSACTIONS_DB_SCHEMA_VERSION,
+            t_db.session.query(SchemaVersion).get(
+                TRANSACTIONS_DB_SCHEMA_NAME).schema_version)
+        t_db.close()
+        self.assertEqual('delete',
+                         engine.execute('PRAGMA journal_mode').scalar())
+
+    def test_migrations_backup_in_wal_mode(self):
+        """Test that the backup also holds the transactions that are still
+        in the write-ahead log."""
+        temp_db_path, engine = self._get_fixture_db('_test_backup')
+        # the connection stays open, otherwise closing it would checkpoint
+        # the log into the database file
+        conn = sqlite3.connect(temp_db_path)
+        self.addCleanup(conn.close)
+        conn.execute('PRAGMA journal_mode=WAL')
+        for _ in range(20):
+            conn.execute("INSERT INTO transactions (name) VALUES ('wal')")
+            conn.commit()
+        count = conn.execute('SELECT COUNT(*) FROM transactions').fetchone()
+        self.assertTrue(os.path.getsize(temp_db_path + '-wal'))
+
+        TransactionDB(engine, db_file_path=temp_db_path)
+
+        backup = sqlite3.connect(temp_db_path + '.v_1.bkp')
+        self.addCleanup(backup.close)
+        self.assertEqual(
+            count, backup.execute('SELECT COUNT(*) FROM transactions'
+                                  ).fetchone())
+
+    def test_migrations_failing_version_rolled_back(self):
+        """Test that a failing command rolls back the DDL and the
+        schema_version of its version, but keeps the versions before."""
+        temp_db_path, engine = self._get_fixture_db('_test_rollback')
+        failing = [
+            text("ALTER TABLE transactions ADD COLUMN task_skipped INT "
+                 "DEFAULT 0"),
+            text("UPDATE no_such_table SET x = 1")
+        ]
+        with patch.dict(migrations.COMPILED_MIGRATIONS, {3: failing}):
+            with self.assertRaises(OperationalError):
+                TransactionDB(engine, db_file_path=temp_db_path)
+
+        columns = [column['name']
+                   for column in inspect(engine).get_columns('transactions')]
+        self.assertIn('task_progress', columns)
+        self.assertNotIn('task_skipped', columns)
+        self.assertEqual(
+            2, engine.execute("SELECT schema_version FROM schema_version"
+                              ).scalar())
+
+    def test_migrations_sqlite3_transaction_control(self):
+        """Test that the DDL of a version runs inside the explicit
+        transaction, with the sqlite3 module's own transaction control off.
+        Before Python 3.6 it committed implicitly ahead of DDL statements."""
+        temp_db_path, engine = self._get_fixture_db('_test_isolation')
+        states = []
+
+        def before_execute(conn, cursor, statement, *args):
+            if statement.startswith('ALTER TABLE'):
+                dbapi_connection = conn.connection.connection
+                states.append((dbapi_connection.isolation_level,
+                               dbapi_connection.in_transaction))
+
+        event.listen(engine, 'before_cursor_execute', before_execute)
+        TransactionDB(engine, db_file_path=temp_db_path)
+
+        self.assertTrue(states)
+        self.assertEqual({(None, True)}, set(states))
+
+    def test_migrate_status(self):
+        """Test that the status backfill reaches every row, committing once
+        per chunk of transaction ids."""
+        engine = self._get_temp_db(8)
+        t_db = TransactionDB(engine)
+        states = ['send_to_pacs', 'report', None, 'report', 'send_to_pacs']
+        t_ids = [t_db.create_transaction(Transaction()) for _ in states]
+        t_db.update_many([(t_id, {'processing_state': state})
+                          for t_id, state in zip(t_ids, states)])
+        session = t_db.session
+
+        with patch.object(session, 'commit',
+                          wraps=session.commit) as commit:
+            migrations.migrate_status(session, Transaction, batch_size=2)
+
+        self.assertEqual(3, commit.call_count)
+        expected = ['sent_to_pacs', 'unseen', None, 'unseen', 'sent_to_pacs']
+        for t_id, status in zip(t_ids, expected):
+            self.assertEqual(status, t_db.get_transaction(t_id).status)
+        t_db.close()
+
+    def test_migration_scripts_run_once(self):
+        """Test that every migration script runs once when migrating."""
+        temp_folder = tempfile.mkdtemp(suffix='_test_migrations_scripts')
+        self.addCleanup(shutil.rmtree, temp_folder)
+        temp_db_path = os.path.join(temp_folder, 't_v1.db')
+        shutil.copy('tests/fixtures/t_v1.db', temp_db_path)
+        engine = create_engine('sqlite:///' + temp_db_path)
+        script = MagicMock()
+
+        with patch.dict(migrations.MIGRATIONS_SCRIPTS, {5: [script]},
+                        clear=True):
+            TransactionDB(engine, db_file_path=temp_db_path)
+
+        self.assertEqual(1, script.call_count)
+
+    def test_migrations_queue_index(self):
+        """Test that migrated and new databases have the peek_queued index."""
+        temp_folder = tempfile.mkdtemp(suffix='_test_migrations_index')
+        self.addCleanup(shutil.rmtree, temp_folder)
+        temp_db_path = os.path.join(temp_folder, 't_v1.db')
+        shutil.copy('tests/fixtures/t_v1.db', temp_db_path)
+        migrated_engine = create_engine('sqlite:///' + temp_db_path)
+        TransactionDB(migrated_engine, db_file_path=temp_db_path)
+        new_engine = self._get_temp_db(6)
+        TransactionDB(new_engine)
+
+        for engine in [migrated_engine, new_engine]:
+            indexes = {
+                index['name']: index['column_names']
+                for index in inspect(engine).get_indexes('transactions')}
+            self.assertEqual(
+                ['task_state', 'archived', 'processing_state',
+                 'transaction_id'],
+                indexes['ix_tx_queue'])
+
+    def test_migrations_skipped_on_matching_schema(self):
+        """Test that an up-to-date schema with an old version isn't migrated
+        again."""
+        engine = self._get_temp_db(7)
+        t_db = TransactionDB(engine)
+        self.assertEqual(TRANSACTIONS_SCHEMA_CHECKSUM,
+                         get_schema_checksum(engine))
+        db_version = t_db.session.query(SchemaVersion).get(
+            TRANSACTIONS_DB_SCHEMA_NAME)
+        db_version.schema_version = 10
+        t_db.session.commit()
+        t_db.close()
+
+        # the schema version of the first engine is cached
+        engine = self._get_temp_db(7)
+        with patch('mediaire_toolbox.transaction_db.transaction_db.migrate'
+                   ) as migrate:
+            t_db = TransactionDB(engine)
+        migrate.assert_not_called()
+        self.assertEqual(
+            TRANSACTIONS_DB_SCHEMA_VERSION,
+            t_db.session.query(SchemaVersion).get(
+                TRANSACTIONS_DB_SCHEMA_NAME).schema_version)
+        t_db.close()
+
+    def test_migrations_old_schema_checksum(self):
+        """Test that an old schema doesn't match the checksum and is
+        migrated."""
+        temp_folder = tempfile.mkdtemp(suffix='_test_migrations_checksum')
+        self.addCleanup(shutil.rmtree, temp_folder)
+        temp_db_path = os.path.join(temp_folder, 't_v1.db')
+        shutil.copy('tests/fixtures/t_v1.db', temp_db_path)
+        engine = create_engine('sqlite:///' + temp_db_path)
+        self.assertNotEqual(TRANSACTIONS_SCHEMA_CHECKSUM,
+                            get_schema_checksum(engine))
+
+        TransactionDB(engine, db_file_path=temp_db_path)
+        self.assertEqual(TRANSACTIONS_SCHEMA_CHECKSUM,
+                         get_schema_checksum(engine))
+
     def test_migrations_users_sites_foreign_keys(self):
         "Test that transactions table is migrated with site_id foreign key."""
         temp_folder = tempfile.mkdtemp(suffix='_test_migrations_site_id')
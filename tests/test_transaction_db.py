@@ -2,24 +2,28 @@ import unittest
 import tempfile
 import shutil
 import json
+import math
 import os
 import types
 import sys
 import traceback
 from datetime import datetime, date, timezone
+from unittest.mock import patch
 
 from sqlite3 import OperationalError as Sqlite3OperationalError
 from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.sql import sqltypes
 
-from mediaire_toolbox.transaction_db.transaction_db import (TransactionDB,
-                                                            utcnow)
+from mediaire_toolbox.transaction_db.transaction_db import (
+    TransactionDB, utcnow, set_message_t_id
+)
 from mediaire_toolbox.transaction_db.model import (
     TaskState, Transaction, UserTransaction, User, Role, UserRole,
-    StudiesMetadata, Site, UserSite
+    StudiesMetadata, Site, UserSite, create_all
 )
 from mediaire_toolbox.transaction_db.exceptions import TransactionDBException
+from mediaire_toolbox.transaction_db import json_codec
 
 from temp_db_base import TempDBFactory
 
@@ -53,6 +57,47 @@ class TestTransactionDB(unittest.TestCase):
         t_1 = t_db_1.get_transaction(1)
         self.assertEqual('Pere', t_1.name)
 
+    def test_sqlite_pragmas(self):
+        engine = temp_db.get_temp_db()
+        TransactionDB(engine)
+        self.assertEqual('wal', engine.execute('PRAGMA journal_mode').scalar())
+        # NORMAL
+        self.assertEqual(1, engine.execute('PRAGMA synchronous').scalar())
+
+        engine = temp_db.get_temp_db()
+        TransactionDB(engine, sqlite_pragmas={'synchronous': 'FULL',
+                                              'busy_timeout': 1000})
+        self.assertEqual(2, engine.execute('PRAGMA synchronous').scalar())
+        self.assertEqual(1000, engine.execute('PRAGMA busy_timeout').scalar())
+
+    def test_sqlite_pragmas_registered_once_per_engine(self):
+        engine = temp_db.get_temp_db()
+        for _ in range(3):
+            TransactionDB(engine)
+        self.assertEqual(1, len(engine.pool.dispatch.connect))
+
+        with self.assertLogs(
+                'mediaire_toolbox.transaction_db.transaction_db',
+                level='WARNING'):
+            TransactionDB(engine, sqlite_pragmas={'synchronous': 'FULL'})
+        self.assertEqual(1, len(engine.pool.dispatch.connect))
+        # NORMAL, the PRAGMAs of the first instance
+        self.assertEqual(1, engine.execute('PRAGMA synchronous').scalar())
+
+    def test_schema_version_cached_per_engine(self):
+        engine = temp_db.get_temp_db()
+        TransactionDB(engine)
+
+        with patch('mediaire_toolbox.transaction_db.transaction_db'
+                   '.create_all', wraps=create_all) as create_all_mock:
+            t_db = TransactionDB(engine)
+            create_all_mock.assert_not_called()
+            TransactionDB(temp_db.get_temp_db())
+            create_all_mock.assert_called_once()
+        # the cached engine still works as usual
+        t_id = t_db.create_transaction(self._get_test_transaction())
+        self.assertEqual('Pere', t_db.get_transaction(t_id).name)
+
     def test_read_transaction_from_dict(self):
         d = {
             'transaction_id': 1, 'name': 'John Doe',
@@ -138,6 +183,24 @@ class TestTransactionDB(unittest.TestCase):
         self.assertEqual('series_t1_1;series_t2_1',
                          tr_2.sequences)
 
+    def test_create_transaction_index_sequences_nan(self):
+        engine = temp_db.get_temp_db()
+        tr_1 = self._get_test_transaction()
+        tr_1.last_message = json.dumps({
+            'data': {
+                'volumes': {'lesion': float('nan')},
+                'dicom_info': {
+                    't1': {'header': {'SeriesDescription': 'series_t1_1'}},
+                    't2': {'header': {'SeriesDescription': 'series_t2_1'}}}
+            }
+        })
+        t_db = TransactionDB(engine)
+        t_id = t_db.create_transaction(tr_1)
+        tr_2 = t_db.get_transaction(t_id)
+
+        self.assertEqual('series_t1_1;series_t2_1',
+                         tr_2.sequences)
+
     def test_create_transaction_lm(self):
         engine = temp_db.get_temp_db()
         tr_1 = self._get_test_transaction()
@@ -155,6 +218,84 @@ class TestTransactionDB(unittest.TestCase):
 
         self.assertEqual(t_id, json.loads(tr_2.last_message)['t_id'])
 
+    def test_set_message_t_id(self):
+        for last_message, expected in [
+                ('{}', {'t_id': 3}),
+                ('{ }', {'t_id': 3}),
+                ('{"data": {"a": 1}}', {'t_id': 3, 'data': {'a': 1}}),
+                ('{"t_id": null, "data": 1}', {'t_id': 3, 'data': 1}),
+                ('{"data": {"t_id": 1}}', {'t_id': 3, 'data': {'t_id': 1}})]:
+            with self.subTest(last_message=last_message):
+                self.assertEqual(
+                    expected,
+                    json.loads(set_message_t_id(last_message, 3)))
+        for last_message in ['[1, 2]', 'not json', '{not json']:
+            with self.subTest(last_message=last_message):
+                self.assertEqual(last_message,
+                                 set_message_t_id(last_message, 3))
+
+    def test_json_codec(self):
+        message = {'t_id': 1, 'data': {'dicom_info': {'t1': None}}}
+        serialized = json_codec.dumps(message)
+
+        self.assertIsInstance(serialized, str)
+        self.assertEqual(message, json_codec.loads(serialized))
+        self.assertEqual(message, json.loads(serialized))
+
+    def test_json_codec_compact(self):
+        # the same formatting whether orjson or the json module serializes
+        for value, serialized in [
+                (1, '{"t_id":1,"data":[1]}'),
+                (float('nan'), '{"t_id":1,"data":[NaN]}'),
+                (2 ** 70, '{"t_id":1,"data":[1180591620717411303424]}')]:
+            with self.subTest(value=value):
+                self.assertEqual(
+                    serialized,
+                    json_codec.dumps({'t_id': 1, 'data': [value]}))
+        self.assertEqual('{"t_id":1,"data":2}',
+                         set_message_t_id('{"data":2}', 1))
+
+    @unittest.skipIf(json_codec.orjson is None, 'orjson is not installed')
+    def test_json_codec_long_digits_in_strings(self):
+        message = json.dumps({'data': {'dicom_info': {'t1': {
+            'header': {'SeriesInstanceUID': (
+                '1.3.12.2.1107.5.2.43.66035.'
+                '30000019041506342290100000007')},
+            'uid': '2.25.' + '1' * 39}}}})
+
+        with patch('json.loads') as mock_loads:
+            loaded = json_codec.loads(message)
+
+        mock_loads.assert_not_called()
+        self.assertEqual(json.loads(message), loaded)
+        for message in ['12345678901234567890', '[1, 12345678901234567890]',
+                        '{"a": -12345678901234567890 }']:
+            with self.subTest(message=message):
+                self.assertEqual(json.loads(message),
+                                 json_codec.loads(message))
+
+    def test_json_codec_non_finite_numbers(self):
+        message = json.dumps({'volume': float('nan'), 'max': float('inf')})
+
+        loaded = json_codec.loads(message)
+
+        self.assertTrue(math.isnan(loaded['volume']))
+        self.assertEqual(float('inf'), loaded['max'])
+        with self.assertRaises(ValueError):
+            json_codec.loads('{not json')
+
+        for value in [float('nan'), float('inf'), 2 ** 70]:
+            with self.subTest(value=value):
+                message = {'t_id': None, 'data': {'vol': value}}
+                self.assertEqual(
+                    json.dumps(message),
+                    json.dumps(json_codec.loads(json_codec.dumps(message))))
+                patched = json_codec.loads(
+                    set_message_t_id(json.dumps(message), 5))
+                self.assertEqual(5, patched['t_id'])
+                self.assertEqual(json.dumps(value),
+                                 json.dumps(patched['data']['vol']))
+
     def test_get_transaction(self):
         engine = temp_db.get_temp_db()
         tr_1 = self._get_test_transaction()
@@ -403,6 +544,29 @@ class TestTransactionDB(unittest.TestCase):
         t_db = TransactionDB(engine)
         t_db.get_transaction(1)
 
+    def test_set_on_non_existing_transaction(self):
+        """test that setters fail if the transaction doesn't exist"""
+        engine = temp_db.get_temp_db()
+        t_db = TransactionDB(engine)
+        setters = [
+            lambda: t_db.set_queued(1, '', 'wait'),
+            lambda: t_db.set_status(1, 'reviewed'),
+            lambda: t_db.set_skipped(1, 'cause'),
+            lambda: t_db.set_cancelled(1),
+            lambda: t_db.set_archived(1),
+            lambda: t_db.set_last_message(1, 'last_message'),
+            lambda: t_db.set_patient_consent(1),
+            lambda: t_db.unset_patient_consent(1),
+            lambda: t_db.set_qa_score(1, 'good'),
+            lambda: t_db.set_billable(1, 'bill'),
+            lambda: t_db.set_priority(1, 2),
+        ]
+        for i, setter in enumerate(setters):
+            with self.subTest(setter=i):
+                with self.assertRaises(TransactionDBException):
+                    setter()
+        t_db.close()
+
     def test_transaction_with_user_id(self):
         engine = temp_db.get_temp_db()
         tr_1 = self._get_test_transaction()
@@ -423,6 +587,20 @@ class TestTransactionDB(unittest.TestCase):
 
         t_db.close()
 
+    def test_transaction_with_non_existing_user_id(self):
+        engine = temp_db.get_temp_db()
+        tr_1 = self._get_test_transaction()
+
+        t_db = TransactionDB(engine)
+        with self.assertRaises(TransactionDBException):
+            t_db.create_transaction(tr_1, user_id=1)
+
+        # the transaction is not persisted when the user doesn't exist
+        self.assertEqual(0, t_db.session.query(Transaction).count())
+        self.assertEqual(0, t_db.session.query(UserTransaction).count())
+
+        t_db.close()
+
     def test_transaction_with_product_id(self):
         engine = temp_db.get_temp_db()
         tr_1 = self._get_test_transaction()
@@ -479,19 +657,19 @@ class TestTransactionDB(unittest.TestCase):
         t = t_db.get_transaction(t_id)
         self.assertEqual(0, t.patient_consent)
 
-        orig_f = t_db._get_transaction_or_raise_exception
+        orig_f = t_db._update_transaction
 
         should_fail_once = True
 
-        def mocked_f(t_id):
+        def mocked_f(t_id, fields):
             nonlocal should_fail_once
             if should_fail_once:
                 should_fail_once = False
                 # Raising this exception means it should be retried
                 raise OperationalError(None, None, None)
-            return orig_f(t_id)
+            return orig_f(t_id, fields)
 
-        t_db._get_transaction_or_raise_exception = mocked_f
+        t_db._update_transaction = mocked_f
 
         try:
             t_db.set_patient_consent(t_id)
@@ -514,19 +692,19 @@ class TestTransactionDB(unittest.TestCase):
         t = t_db.get_transaction(t_id)
         self.assertEqual(0, t.patient_consent)
 
-        orig_f = t_db._get_transaction_or_raise_exception
+        orig_f = t_db._update_transaction
 
         should_fail_once = True
 
-        def mocked_f(t_id):
+        def mocked_f(t_id, fields):
             nonlocal should_fail_once
             if should_fail_once:
                 should_fail_once = False
                 # Raising this exception means it should be retried
                 raise Sqlite3OperationalError
-            return orig_f(t_id)
+            return orig_f(t_id, fields)
 
-        t_db._get_transaction_or_raise_exception = mocked_f
+        t_db._update_transaction = mocked_f
 
         try:
             t_db.set_patient_consent(t_id)
@@ -597,6 +775,102 @@ class TestTransactionDB(unittest.TestCase):
 
         t_db.close()
 
+    def test_update_transaction(self):
+        engine = temp_db.get_temp_db()
+        tr_1 = self._get_test_transaction()
+
+        t_db = TransactionDB(engine)
+        t_id = t_db.create_transaction(tr_1)
+
+        t_db.update_transaction(t_id, status='reviewed', priority=3,
+                                task_state=TaskState.failed)
+        t = t_db.get_transaction(t_id)
+        self.assertEqual('reviewed', t.status)
+        self.assertEqual(3, t.priority)
+        self.assertEqual(TaskState.failed, t.task_state)
+
+        t_db.close()
+
+    def test_update_transaction_invalid_field(self):
+        engine = temp_db.get_temp_db()
+        tr_1 = self._get_test_transaction()
+
+        t_db = TransactionDB(engine)
+        t_id = t_db.create_transaction(tr_1)
+
+        with self.assertRaises(TransactionDBException):
+            t_db.update_transaction(t_id, status='reviewed', name='Joan')
+        t = t_db.get_transaction(t_id)
+        self.assertEqual('Pere', t.name)
+        self.assertEqual(None, t.status)
+
+        t_db.close()
+
+    def test_update_transaction_non_existing(self):
+        engine = temp_db.get_temp_db()
+        t_db = TransactionDB(engine)
+
+        with self.assertRaises(TransactionDBException):
+            t_db.update_transaction(1, status='reviewed')
+
+        t_db.close()
+
+    def test_update_transaction_no_fields(self):
+        engine = temp_db.get_temp_db()
+        t_db = TransactionDB(engine)
+        t_id = t_db.create_transaction(self._get_test_transaction())
+
+        with patch('time.sleep') as mock_sleep, \
+                self.assertRaises(TransactionDBException):
+            t_db.update_transaction(t_id)
+        # rejected up front, not retried as a failing statement
+        mock_sleep.assert_not_called()
+
+        t_db.close()
+
+    def test_update_many(self):
+        engine = temp_db.get_temp_db()
+        t_db = TransactionDB(engine)
+        t_id_1 = t_db.create_transaction(self._get_test_transaction())
+        t_id_2 = t_db.create_transaction(self._get_test_transaction())
+
+        t_db.update_many([(t_id_1, {'status': 'reviewed'}),
+                          (t_id_2, {'archived': 1}),
+                          (t_id_1, {'priority': 2})])
+        t_1 = t_db.get_transaction(t_id_1)
+        self.assertEqual('reviewed', t_1.status)
+        self.assertEqual(2, t_1.priority)
+        self.assertEqual(0, t_1.archived)
+        t_2 = t_db.get_transaction(t_id_2)
+        self.assertEqual(None, t_2.status)
+        self.assertEqual(1, t_2.archived)
+
+        with self.assertRaises(TransactionDBException):
+            t_db.update_many([(t_id_1, {'name': 'Joan'})])
+
+        # a missing id doesn't keep the other updates from being applied
+        t_db.update_many([(t_id_2 + 1, {'status': 'a'}),
+                          (t_id_2, {'status': 'b'})])
+        self.assertEqual('b', t_db.get_transaction(t_id_2).status)
+
+        t_db.close()
+
+    def test_update_many_no_fields(self):
+        engine = temp_db.get_temp_db()
+        t_db = TransactionDB(engine)
+        t_id_1 = t_db.create_transaction(self._get_test_transaction())
+        t_id_2 = t_db.create_transaction(self._get_test_transaction())
+
+        with patch('time.sleep') as mock_sleep:
+            t_db.update_many([(t_id_1, {}), (t_id_2, {'priority': 2})])
+            t_db.update_many([(t_id_1, {})])
+            t_db.update_many([])
+        mock_sleep.assert_not_called()
+        self.assertEqual(0, t_db.get_transaction(t_id_1).priority)
+        self.assertEqual(2, t_db.get_transaction(t_id_2).priority)
+
+        t_db.close()
+
     def test_add_user_ok(self):
         """test that we can add User entity"""
         engine = temp_db.get_temp_db()
@@ -791,6 +1065,31 @@ class TestTransactionDB(unittest.TestCase):
 
         self.assertEqual('longitudinal_grazer', md.origin)
 
+    def test_study_metadata_read_after_overwrite(self):
+        engine = temp_db.get_temp_db()
+        writer = TransactionDB(engine)
+        reader = TransactionDB(engine)
+
+        writer.add_study_metadata('s1', 'one', utcnow())
+        # keep a reference, so it stays in the reader's identity map
+        metadata = reader.get_study_metadata('s1')
+        self.assertEqual('one', metadata.origin)
+        writer.add_study_metadata('s1', 'two', utcnow(), overwrite=True)
+        self.assertEqual('two', reader.get_study_metadata('s1').origin)
+
+    def test_study_metadata_not_overwritten(self):
+        engine = temp_db.get_temp_db()
+        t_db = TransactionDB(engine)
+        c_move_time = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+        t_db.add_study_metadata('s1', 'dicom_grazer', c_move_time)
+        with self.assertRaises(TransactionDBException):
+            t_db.add_study_metadata('s1', 'longitudinal_grazer', utcnow())
+
+        md = t_db.get_study_metadata('s1')
+        self.assertEqual('dicom_grazer', md.origin)
+        self.assertEqual(c_move_time, md.c_move_time)
+
     def test_study_metadata_to_dict(self):
         md = StudiesMetadata()
         md.origin = 'dicom_grazer'